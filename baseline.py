@@ -0,0 +1,38 @@
+#!/usr/bin/env python2
+"""
+Per-waveform baseline estimation of DDC2 waveforms.
+"""
+import numpy as np
+
+
+METHODS = ['global', 'mean', 'median', 'running']
+
+# Number of pre-trigger samples for each AF_SET_PRE_CONFIG setting
+PRE_CONFIG_SAMPLES = {0: 64, 1: 16, 2: 32, 3: 64, 4: 128}
+
+
+def estimate(adc, pre_samples, method='mean'):
+    """Baseline of every row of a (n_waveforms, nsamples) ADC matrix at once
+
+    The baseline is taken from the first pre_samples samples of each
+    waveform, recorded before the trigger. 'running' gives the mean, which
+    running_mean then smooths over consecutive waveforms.
+    """
+    pre = np.atleast_2d(adc)[:, :pre_samples]
+    if method == 'median':
+        return np.median(pre, axis=1)
+    elif method in ('mean', 'running'):
+        return pre.mean(axis=1)
+    raise ValueError('Unknown baseline method {0}'.format(method))
+
+
+def running_mean(values, window):
+    """Mean of each value and the window-1 values before it
+
+    The first values are averaged over as many as are available.
+    """
+    values = np.asarray(values, dtype=float)
+    cumsum = np.concatenate([[0.], np.cumsum(values)])
+    stop = np.arange(1, len(values) + 1)
+    start = np.maximum(stop - window, 0)
+    return (cumsum[stop] - cumsum[start]) / (stop - start)
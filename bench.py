@@ -0,0 +1,409 @@
+#!/usr/bin/env python2
+"""
+Benchmarks the acquisition parsing, level1 processing and plotting on the
+bundled and synthetic level0 data.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+import gzip
+import json
+from multiprocessing import Pipe, Process
+import os, sys
+import platform
+import resource
+import subprocess
+import time
+from timeit import default_timer as timer
+
+import matplotlib as mpl
+mpl.use('Agg')
+import numpy as np
+
+import l1
+import plot_charge
+import plot_wv
+import run as acquisition
+
+
+DATASETS = OrderedDict([
+    ('run0', './data/0616/run0'),
+    ('run1', './data/0616/run1'),
+    ('test_run', './data/0616/test_run')
+])
+
+WF_HEADER = (
+    '              word   len  full  state  empty  loop  reenter  run '
+    'start_idx  stop_idx trig\n'
+    'header: 0x01205030   288     0      5      0     0        0    0'
+    '         0         3    0\n'
+    'footer: 0x01201030   288     0      1      0     0        0    0'
+    '         0         3    0\n'
+    '\n'
+    'start timestamp  = {0:15d}, 0x{0:12x}\n'
+    'start local time = {1:15d}, 0x{1:12x}\n'
+    '\n'
+    'Nsamples = {2}\n'
+    '\n'
+    'isamp   adc   time  tot  eoe\n'
+)
+
+SAMPLE_FORMAT = '%5d, %5d, %5d, %3d, %3d, \n'
+
+
+def parse_args():
+    """Get command line arguments"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-b', '--benchmarks', type=str, nargs='+', default=None,
+        choices=BENCHMARKS.keys(), metavar='NAME', required=False,
+        help='''Benchmarks to run, out of {0}, all by default'''.format(
+            ', '.join(BENCHMARKS.keys())
+        )
+    )
+    parser.add_argument(
+        '-d', '--datasets', type=str, nargs='+', default=None,
+        metavar='NAME', required=False,
+        help='''Datasets to run on, out of {0} and synthetic, all by
+        default'''.format(', '.join(DATASETS.keys()))
+    )
+    parser.add_argument(
+        '-n', '--nwaveforms', type=int, default=10000, metavar='INT',
+        required=False,
+        help='''Number of waveforms in the synthetic level0 run, 0 to skip
+        it'''
+    )
+    parser.add_argument(
+        '--chunk', type=int, default=10000, metavar='INT', required=False,
+        help='''Number of waveforms per synthetic level0 chunk'''
+    )
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3, metavar='INT', required=False,
+        help='''Number of times to run each benchmark'''
+    )
+    parser.add_argument(
+        '-w', '--workdir', type=str, default='./data/bench', metavar='FOLDER',
+        required=False,
+        help='''Folder for the synthetic data, intermediate files and
+        results'''
+    )
+    parser.add_argument(
+        '-c', '--compare', type=str, default=None, metavar='FILE',
+        required=False,
+        help='''Results of a previous benchmark to compare against'''
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', default=False,
+        help='''Verbose'''
+    )
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_run(outdir, nwaveforms, chunk=10000, nsamples=320,
+                  baseline=9072, seed=0):
+    """Write a run of synthetic level0 text chunks, as from record_raw
+
+    Each waveform is white noise around the baseline with a negative going
+    pulse of random amplitude starting around a third of the way in. Runs
+    already generated with the same parameters are reused.
+    """
+    done = os.path.join(outdir, 'synthetic.json')
+    config = {
+        'nwaveforms': nwaveforms, 'chunk': chunk, 'nsamples': nsamples,
+        'baseline': baseline, 'seed': seed
+    }
+    if os.path.exists(done):
+        with open(done) as f:
+            if json.load(f) == config:
+                return outdir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    for filename in os.listdir(outdir):
+        os.remove(os.path.join(outdir, filename))
+
+    print 'Generating {0} synthetic waveforms in {1}'.format(
+        nwaveforms, outdir
+    )
+    rng = np.random.RandomState(seed)
+    isamp = np.arange(nsamples)
+    sample_format = SAMPLE_FORMAT * nsamples
+    fpga_ts = 168732212064
+    for ichunk, first in enumerate(range(0, nwaveforms, chunk)):
+        n_wf = min(chunk, nwaveforms - first)
+        t = isamp - rng.normal(nsamples / 3., 2., (n_wf, 1))
+        amplitude = rng.normal(3000., 1000., (n_wf, 1)).clip(0)
+        pulse = amplitude * (np.exp(-t / 8.) - np.exp(-t / 2.)) * (t > 0)
+        adc = baseline + rng.normal(0., 2., (n_wf, nsamples)) - pulse
+        adc = adc.round().clip(0, 16383).astype(int)
+
+        rows = np.zeros((nsamples, 5), dtype=int)
+        rows[:,0] = isamp
+        rows[-1,4] = 1
+        filename = 'level0_{0:06d}.txt.gz'.format(ichunk)
+        with gzip.open(os.path.join(outdir, filename), 'wb', 1) as f:
+            if ichunk == 0:
+                f.write('BASELINE = {0}\n\n'.format(baseline))
+            for idx in range(n_wf):
+                fpga_ts += rng.randint(20000, 400000)
+                local_time = fpga_ts & 0xffff
+                rows[:,1] = adc[idx]
+                rows[:,2] = (local_time - 128 + isamp) & 0xffff
+                f.write(WF_HEADER.format(fpga_ts, local_time, nsamples))
+                f.write(sample_format % tuple(rows.ravel()))
+                f.write('\n' + l1.SEPARATOR + '\n')
+    with open(done, 'w') as f:
+        json.dump(config, f)
+    return outdir
+
+
+def l1_file(path, workdir, name):
+    """Level1 output of a dataset, produced once and reused by the plots"""
+    outfile = os.path.join(workdir, '{0}_l1.h5'.format(name))
+    if not os.path.exists(outfile):
+        l1.run(path, outfile, no_invert=False, verbose=False)
+    return outfile
+
+
+def sample_lines(path):
+    """The sample lines of a level0 run, as read from nios2-terminal"""
+    lines = l1.l0_lines(l1.l0_files(path))
+    return [line for line in lines if line.count(',') == 5]
+
+
+def bench_parse(path, workdir, name):
+    """run.parse on every sample line"""
+    lines = sample_lines(path)
+    def bench():
+        for line in lines:
+            map(int, acquisition.parse(line))
+        return len(lines)
+    return bench
+
+
+def bench_waveform_buffer(path, workdir, name):
+    """run.WaveformBuffer.feed on every line of a level0 run"""
+    lines = list(l1.l0_lines(l1.l0_files(path)))
+    def bench():
+        wf_buffer = acquisition.WaveformBuffer()
+        for line in lines:
+            wf_buffer.feed(line)
+        return len(wf_buffer.result())
+    return bench
+
+
+def bench_run(path, workdir, name):
+    """run.run replaying the level0 data as fast as possible"""
+    def bench():
+        data = acquisition.run(None, None, 1e9, False, False, replay=path)
+        return data.shape[0]
+    return bench
+
+
+def bench_l1(path, workdir, name):
+    """l1.run from level0 to level1"""
+    outfile = os.path.join(workdir, '{0}_bench_l1.h5'.format(name))
+    def bench():
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        l1.run(path, outfile, no_invert=False, verbose=False)
+        return None
+    return bench
+
+
+def bench_plot_charge(path, workdir, name):
+    """plot_charge.run on the level1 output"""
+    infile = l1_file(path, workdir, name)
+    outfile = os.path.join(workdir, '{0}_charge.png'.format(name))
+    def bench():
+        plot_charge.run([infile], outfile, bins=100)
+        return None
+    return bench
+
+
+def bench_plot_wv(path, workdir, name):
+    """plot_wv.run of the first 100 waveforms of the level1 output"""
+    infile = l1_file(path, workdir, name)
+    outfile = os.path.join(workdir, '{0}_wv.png'.format(name))
+    def bench():
+        plot_wv.run(infile, outfile, interp=False, nplot=100, ymax=1000)
+        return None
+    return bench
+
+
+BENCHMARKS = OrderedDict([
+    ('parse', bench_parse),
+    ('waveform_buffer', bench_waveform_buffer),
+    ('run', bench_run),
+    ('l1', bench_l1),
+    ('plot_charge', bench_plot_charge),
+    ('plot_wv', bench_plot_wv)
+])
+
+
+def max_rss():
+    """Peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(conn, benchmark, path, workdir, name, verbose):
+    """Set up and time one benchmark, sending the result down conn"""
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        bench = BENCHMARKS[benchmark](path, workdir, name)
+        rss_setup = max_rss()
+        start = timer()
+        items = bench()
+        seconds = timer() - start
+        conn.send({
+            'seconds': seconds, 'items': items, 'max_rss_mb': max_rss(),
+            'setup_rss_mb': rss_setup
+        })
+    except BaseException as e:
+        message = str(e).strip().split('\n')[0]
+        conn.send({'error': '{0}: {1}'.format(type(e).__name__, message)})
+
+
+def measure_isolated(benchmark, path, workdir, name, verbose):
+    """Run measure in a fresh process, so peak memory is per benchmark"""
+    parent, child = Pipe()
+    p = Process(
+        target=measure, args=(child, benchmark, path, workdir, name, verbose)
+    )
+    p.start()
+    result = parent.recv()
+    p.join()
+    return result
+
+
+def summarise(results):
+    """Best and median time, throughput and peak memory over the repeats"""
+    errors = [r['error'] for r in results if 'error' in r]
+    if errors:
+        return {'error': errors[0]}
+    seconds = [r['seconds'] for r in results]
+    summary = {
+        'min': np.min(seconds), 'median': np.median(seconds),
+        'max_rss_mb': max(r['max_rss_mb'] for r in results),
+        'setup_rss_mb': max(r['setup_rss_mb'] for r in results),
+        'repeat': len(seconds)
+    }
+    if results[0]['items'] is not None:
+        summary['items'] = results[0]['items']
+        summary['items_per_s'] = results[0]['items'] / summary['min']
+    return summary
+
+
+def git_commit():
+    """Commit of the working tree, marked dirty if it has changes"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=open(os.devnull, 'w')
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit.strip()
+
+
+def print_results(results, reference=None):
+    """Table of the results, with the time relative to reference if given"""
+    if reference is None:
+        reference = {}
+    print '{0:<28} {1:>10} {2:>10} {3:>12} {4:>10} {5:>8}'.format(
+        'benchmark', 'min (s)', 'median (s)', 'items/s', 'rss (MB)', 'ratio'
+    )
+    for key, r in results.items():
+        if 'error' in r:
+            print '{0:<28} {1}'.format(key, r['error'])
+            continue
+        ratio = ''
+        if key in reference and 'min' in reference[key]:
+            ratio = '{0:.2f}'.format(r['min'] / reference[key]['min'])
+        print '{0:<28} {1:10.4f} {2:10.4f} {3:>12} {4:10.1f} {5:>8}'.format(
+            key, r['min'], r['median'],
+            '{0:.0f}'.format(r['items_per_s']) if 'items_per_s' in r else '',
+            r['max_rss_mb'], ratio
+        )
+
+
+def run(benchmarks, datasets, nwaveforms, chunk, repeat, workdir, compare,
+        verbose):
+    """Main function to run the benchmarks and save the results"""
+    if benchmarks is None:
+        benchmarks = BENCHMARKS.keys()
+    paths = OrderedDict(DATASETS)
+    if nwaveforms > 0:
+        name = 'synthetic_{0}'.format(nwaveforms)
+        paths[name] = synthetic_run(
+            os.path.join(workdir, name), nwaveforms, chunk
+        )
+    if datasets is not None:
+        paths = OrderedDict(
+            (name, path) for name, path in paths.items()
+            if name in datasets or
+            (name.startswith('synthetic') and 'synthetic' in datasets)
+        )
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    results = OrderedDict()
+    for name, path in paths.items():
+        for benchmark in benchmarks:
+            key = '{0}/{1}'.format(benchmark, name)
+            print 'Running {0}'.format(key)
+            results[key] = summarise([
+                measure_isolated(benchmark, path, workdir, name, verbose)
+                for _ in range(repeat)
+            ])
+
+    commit = git_commit()
+    output = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results
+    }
+    outfile = os.path.join(workdir, 'bench_{0}_{1}.json'.format(
+        time.strftime('%Y%m%d_%H%M%S'), commit
+    ))
+    with open(outfile, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    reference = None
+    if compare is not None:
+        with open(compare) as f:
+            reference = json.load(f)['results']
+    print '=========='
+    print_results(results, reference)
+    print 'Saving to file', outfile
+    return results
+
+
+def main():
+    args = parse_args()
+    run(
+        benchmarks = args.benchmarks,
+        datasets = args.datasets,
+        nwaveforms = args.nwaveforms,
+        chunk = args.chunk,
+        repeat = args.repeat,
+        workdir = args.workdir,
+        compare = args.compare,
+        verbose = args.verbose
+    )
+
+    print '=========='
+    print 'DONE'
+    print '=========='
+
+
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python2
+"""
+Catalog the runs of the data folders in an SQLite database
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import Counter
+import hashlib
+from multiprocessing import Pool
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+import charge as charge_engine
+from l1 import (
+    BATCH_SIZE, CLOCK, LSB, L0_HEADER_FILE, iter_batches, iter_waveforms,
+    l0_files, l0_lines, l1_binary, l1_waveforms, read_header, read_run_start
+)
+
+
+QUANTILES = [5, 25, 50, 75, 95]
+COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('format', 'TEXT'),
+    ('signature', 'TEXT'),
+    ('n_files', 'INTEGER'),
+    ('size', 'INTEGER'),
+    ('mtime', 'REAL'),
+    ('n_wf', 'INTEGER'),
+    ('nsamples', 'INTEGER'),
+    ('baseline', 'REAL'),
+    ('start_time', 'REAL'),
+    ('t_start', 'REAL'),
+    ('t_stop', 'REAL'),
+    ('trigger_rate', 'REAL'),
+    ('charge_mean', 'REAL')
+] + [('charge_q{0:02d}'.format(q), 'REAL') for q in QUANTILES] + [
+    ('error', 'TEXT'),
+    ('cataloged', 'REAL')
+]
+
+
+def parse_args():
+    """Get command line arguments"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-i', '--folders', type=str, nargs='+', default=['./data'],
+        metavar='FOLDER', required=False,
+        help='''Folders to look for runs in'''
+    )
+    parser.add_argument(
+        '-d', '--db', type=str, default='./data/catalog.sqlite',
+        metavar='FILE', required=False, help='''Path of the catalog'''
+    )
+    parser.add_argument(
+        '-q', '--query', type=str, default=None, metavar='SQL',
+        required=False,
+        help='''Query to print once the catalog is up to date, e.g.
+        "SELECT path, n_wf, charge_q50 FROM runs WHERE format = 'level0'"'''
+    )
+    parser.add_argument(
+        '--no-update', action='store_true', default=False,
+        help='''Only query the catalog, without looking for new runs'''
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='INT', required=False,
+        help='''Number of processes to share the runs between'''
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', default=False,
+        help='''Verbose mode'''
+    )
+    args = parser.parse_args()
+    return args
+
+
+def is_level0(filename):
+    """Whether a file is a level0 chunk, as listed by l1.l0_files"""
+    return filename.endswith('.bin') or '.txt.gz' in filename or \
+        ('dump_' in filename and '.txt' in filename)
+
+
+def is_scope(path):
+    """Whether a file is a trace saved by the oscilloscope"""
+    if not path.endswith('.txt'):
+        return False
+    with open(path) as f:
+        return f.read(15) == '"Record Length"'
+
+
+def find_runs(folder):
+    """Find the runs in a folder, as (path, format, files)
+
+    A folder of level0 chunks is one run, and so is a folder of oscilloscope
+    traces. Every numpy file saved by run.py is a run of its own.
+    """
+    runs = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        paths = [os.path.join(dirpath, f) for f in sorted(filenames)]
+        level0 = [
+            p for p, f in zip(paths, sorted(filenames)) if is_level0(f) or
+            f.endswith('.idx.npy') or f == L0_HEADER_FILE
+        ]
+        if any(is_level0(os.path.basename(p)) for p in level0):
+            runs.append((os.path.normpath(dirpath), 'level0', level0))
+            dirnames[:] = []
+            continue
+        scope = [p for p in paths if is_scope(p)]
+        if scope:
+            runs.append((os.path.normpath(dirpath), 'scope', scope))
+        for path in paths:
+            if path.endswith('.npy'):
+                runs.append((os.path.normpath(path), 'npy', [path]))
+    return runs
+
+
+def signature(files):
+    """Signature of the files of a run, which changes with any of them"""
+    sha = hashlib.sha1()
+    for path in files:
+        stat = os.stat(path)
+        sha.update(repr(
+            (os.path.basename(path), stat.st_size, stat.st_mtime)
+        ))
+    return sha.hexdigest()
+
+
+def charge_summary(charges):
+    """Mean and quantiles of the charges of a run in nVs"""
+    summary = {}
+    if len(charges):
+        summary['charge_mean'] = float(np.mean(charges))
+        for q, value in zip(QUANTILES, np.percentile(charges, QUANTILES)):
+            summary['charge_q{0:02d}'.format(q)] = float(value)
+    return summary
+
+
+def time_summary(fpga_ts):
+    """Time span and mean trigger rate from the FPGA timestamps of a run"""
+    if len(fpga_ts) == 0:
+        return {}
+    t = np.asarray(fpga_ts, dtype=float) * CLOCK * 1e-9
+    summary = {'t_start': float(t.min()), 't_stop': float(t.max())}
+    if len(t) > 1 and t.max() > t.min():
+        summary['trigger_rate'] = (len(t) - 1) / (t.max() - t.min())
+    return summary
+
+
+def summarize_npy(path):
+    """Summary of a numpy file saved by run.py
+
+    The baseline is not saved with the waveforms, so it is taken as the
+    median of all ADC counts, which are mostly away from the pulses.
+    """
+    data = np.load(path, mmap_mode='r')
+    adc = np.asarray(data[:, :, 1])
+    baseline = float(np.median(adc)) if adc.size else None
+    summary = {
+        'n_wf': data.shape[0], 'nsamples': data.shape[1], 'baseline': baseline
+    }
+    charges = np.empty(0)
+    if data.shape[1] > 1:
+        charges = charge_engine.integrate(
+            baseline - adc, CLOCK, 'spline'
+        ) * LSB / 1e3
+    summary.update(charge_summary(charges))
+    if data.shape[2] > 5:
+        # FPGA timestamp saved since the 0207 runs
+        summary.update(time_summary(data[:, 0, 5]))
+    return summary
+
+
+def summarize_level0(path):
+    """Summary of a level0 run folder, with the waveforms l1 would keep"""
+    filenames = l0_files(path)
+    baseline, initial_mk_ts = read_header(filenames[0])
+    _, nsamples, _ = read_run_start(filenames)
+    if filenames[0].endswith('.bin'):
+        parts = (
+            l1_binary(f, baseline, nsamples, False, 'spline', None, False)[1]
+            for f in filenames
+        )
+    else:
+        parts = (
+            l1_waveforms(
+                batch, baseline, nsamples, False, 'spline', None, False
+            )[1]
+            for batch in iter_batches(
+                iter_waveforms(l0_lines(filenames)), BATCH_SIZE
+            )
+        )
+    charges, fpga_ts = [], []
+    for wf in parts:
+        charges.append(wf['charge'].values)
+        fpga_ts.append(wf['fpga_ts'].values)
+    charges = np.concatenate(charges)
+    summary = {
+        'n_wf': len(charges), 'nsamples': nsamples, 'baseline': baseline,
+        'start_time': initial_mk_ts or None
+    }
+    summary.update(charge_summary(charges))
+    summary.update(time_summary(np.concatenate(fpga_ts)))
+    return summary
+
+
+def summarize_scope(path, files):
+    """Summary of a folder of oscilloscope traces, one waveform per file
+
+    The voltage is in V with positive pulses, so the charge is the area
+    above the median voltage of each trace.
+    """
+    traces = [
+        np.genfromtxt(f, delimiter=',', usecols=(3, 4)) for f in files
+    ]
+    nsamples = Counter(len(trace) for trace in traces).most_common(1)[0][0]
+    traces = np.array([trace for trace in traces if len(trace) == nsamples])
+    step = (traces[0, 1, 0] - traces[0, 0, 0]) * 1e9
+    voltage = traces[:, :, 1]
+    baseline = np.median(voltage, axis=1)
+    charges = charge_engine.integrate(
+        voltage - baseline[:, None], step, 'spline'
+    )
+    summary = {
+        'n_wf': len(traces), 'nsamples': nsamples,
+        'baseline': float(np.median(baseline))
+    }
+    summary.update(charge_summary(charges))
+    return summary
+
+
+def summarize(args):
+    """Catalog row of a run, with the error instead if it can not be read"""
+    path, fmt, files, sig = args
+    row = {
+        'path': path, 'format': fmt, 'signature': sig,
+        'n_files': len(files),
+        'size': sum(os.path.getsize(f) for f in files),
+        'mtime': max(os.path.getmtime(f) for f in files),
+        'cataloged': time.time()
+    }
+    try:
+        if fmt == 'npy':
+            row.update(summarize_npy(path))
+        elif fmt == 'level0':
+            row.update(summarize_level0(path))
+        else:
+            row.update(summarize_scope(path, files))
+    except (AssertionError, ValueError, IndexError, KeyError, IOError) as err:
+        row['error'] = '{0}: {1}'.format(type(err).__name__, err)
+    return row
+
+
+def connect(db):
+    """Open the catalog, creating it if needed"""
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE IF NOT EXISTS runs ({0})'.format(
+        ', '.join('{0} {1}'.format(*column) for column in COLUMNS)
+    ))
+    conn.execute('CREATE INDEX IF NOT EXISTS runs_format ON runs (format)')
+    return conn
+
+
+def update(conn, folders, jobs=1, verbose=False):
+    """Catalog the new and changed runs of folders
+
+    Runs are summarized in a pool of jobs processes, skipping those whose
+    files have the same names, sizes and modification times as when they
+    were cataloged. Runs which are gone from folders are removed. Returns
+    the number of runs cataloged.
+    """
+    known = dict(conn.execute('SELECT path, signature FROM runs'))
+    found = set()
+    todo = []
+    for folder in folders:
+        folder = os.path.normpath(folder)
+        for path, fmt, files in find_runs(folder):
+            found.add(path)
+            sig = signature(files)
+            if known.get(path) != sig:
+                todo.append((path, fmt, files, sig))
+        gone = [
+            path for path in known if path not in found and (
+                path == folder or path.startswith(folder + os.sep)
+            )
+        ]
+        conn.executemany(
+            'DELETE FROM runs WHERE path = ?', [(path,) for path in gone]
+        )
+
+    pool = Pool(jobs) if jobs > 1 and len(todo) > 1 else None
+    mapper = pool.imap_unordered if pool else map
+    names = [name for name, _ in COLUMNS]
+    try:
+        for row in mapper(summarize, todo):
+            if verbose:
+                print 'cataloged {0} {1}'.format(
+                    row['path'], row.get('error', '')
+                )
+            conn.execute(
+                'INSERT OR REPLACE INTO runs ({0}) VALUES ({1})'.format(
+                    ', '.join(names), ', '.join('?' * len(names))
+                ),
+                [row.get(name) for name in names]
+            )
+            conn.commit()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    conn.commit()
+    return len(todo)
+
+
+def query(conn, sql):
+    """Result of a query of the catalog as a DataFrame"""
+    return pd.read_sql_query(sql, conn)
+
+
+def main():
+    args = parse_args()
+    conn = connect(args.db)
+    try:
+        if not args.no_update:
+            n_runs = update(
+                conn,
+                folders = args.folders,
+                jobs = args.jobs,
+                verbose = args.verbose
+            )
+            print 'Cataloged {0} new or changed runs'.format(n_runs)
+        if args.query is not None:
+            print query(conn, args.query).to_string()
+    finally:
+        conn.close()
+
+    print '=========='
+    print 'DONE'
+    print '=========='
+
+
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+"""
+Batch charge integration of DDC2 waveforms.
+"""
+import numpy as np
+from scipy import integrate as integrate_
+import scipy.interpolate as interpolate
+
+
+METHODS = ['spline', 'simps', 'trapz']
+
+_weights_cache = {}
+
+
+def quadrature_weights(nsamples, step=1., method='spline', window=None):
+    """Quadrature weights for waveforms sampled at regular intervals
+
+    The area under a waveform y is y.dot(weights) for every method, as each
+    one is linear in the samples. The 'spline' weights reproduce
+    interpolate.splint of the interpolating cubic spline from
+    interpolate.splrep exactly. The window (first, last) gives the range of
+    samples to integrate over, inclusive, and defaults to the whole waveform.
+    """
+    if window is None:
+        window = (0, nsamples - 1)
+    first, last = window
+    if not 0 <= first < last < nsamples:
+        raise ValueError(
+            'Invalid integration window {0} for {1} samples'.format(
+                window, nsamples
+            )
+        )
+    key = (nsamples, step, method, first, last)
+    if key in _weights_cache:
+        return _weights_cache[key]
+
+    x = step * np.arange(nsamples)
+    unit = np.eye(nsamples)
+    weights = np.zeros(nsamples)
+    if method == 'spline':
+        for idx in range(nsamples):
+            tck = interpolate.splrep(x, unit[idx], s=0)
+            weights[idx] = interpolate.splint(x[first], x[last], tck)
+    elif method == 'simps':
+        weights[first:last+1] = integrate_.simps(
+            unit[first:last+1, first:last+1], x[first:last+1], axis=1
+        )
+    elif method == 'trapz':
+        weights[first:last+1] = np.trapz(
+            unit[first:last+1, first:last+1], x[first:last+1], axis=1
+        )
+    else:
+        raise ValueError('Unknown integration method {0}'.format(method))
+    _weights_cache[key] = weights
+    return weights
+
+
+def integrate(waveforms, step=1., method='spline', window=None):
+    """Area under every row of a (n_waveforms, nsamples) array at once"""
+    waveforms = np.atleast_2d(waveforms)
+    weights = quadrature_weights(
+        waveforms.shape[1], step, method,
+        None if window is None else tuple(window)
+    )
+    return np.dot(waveforms, weights)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python2
+"""
+Compare the charge histograms of many level1 files, e.g. for gain scans
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import hashlib
+import json
+from multiprocessing import Pool
+import os
+
+import matplotlib as mpl
+from matplotlib import pyplot as plt
+from matplotlib.offsetbox import AnchoredText
+import numpy as np
+import pandas as pd
+
+import fit as fit_engine
+from plot_charge import charge_histogram, iter_charges
+mpl.rcParams['mathtext.fontset'] = 'custom'
+mpl.rcParams['mathtext.rm'] = 'Bitstream Vera Sans'
+mpl.rcParams['mathtext.it'] = 'Bitstream Vera Sans:italic'
+mpl.rcParams['mathtext.bf'] = 'Bitstream Vera Sans:bold'
+
+
+def parse_args():
+    """Get command line arguments"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-i', '--infiles', type=str, nargs='+', metavar='FILE',
+        required=True, help='''Paths to level1 files'''
+    )
+    parser.add_argument(
+        '-o', '--outfile', type=str, default='./images/compare.png',
+        metavar='FILE', required=False,
+        help='''Output path of figure'''
+    )
+    parser.add_argument(
+        '-b', '--bins', type=int, default=100, metavar='INT', required=False,
+        help='''Number of bins'''
+    )
+    parser.add_argument(
+        '-r', '--range', type=float, nargs=2, default=None, metavar='FLOAT',
+        required=False,
+        help='''Range of the histograms in nVs, by default from the smallest
+        to the largest charge of all files. Fixing it keeps the cached
+        histograms valid when files are added'''
+    )
+    parser.add_argument(
+        '-w', '--where', type=str, default=None, metavar='QUERY',
+        required=False,
+        help='''Select the waveforms to histogram by timestamp and charge,
+        e.g. "charge > 5 & timestamp < 1e12"'''
+    )
+    parser.add_argument(
+        '-m', '--mode', type=str, default='overlay',
+        choices=['overlay', 'combined'], required=False,
+        help='''Overlay the spectra of the files or combine them into one'''
+    )
+    parser.add_argument(
+        '--model', type=str, default='gauss', choices=fit_engine.MODELS,
+        required=False,
+        help='''Model to fit, a single gaussian or the pedestal plus n-PE
+        peaks'''
+    )
+    parser.add_argument(
+        '--fit-method', type=str, default='lsq', choices=fit_engine.METHODS,
+        required=False,
+        help='''Least squares or binned maximum likelihood fit'''
+    )
+    parser.add_argument(
+        '-t', '--table', type=str, default=None, metavar='FILE',
+        required=False, help='''Save the table of fits as csv'''
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='INT', required=False,
+        help='''Number of processes to share the files between'''
+    )
+    parser.add_argument(
+        '--cache', type=str, default='./data/cache/charge', metavar='FOLDER',
+        required=False,
+        help='''Folder to cache the histogram of each file in'''
+    )
+    args = parser.parse_args()
+    return args
+
+
+def cache_key(infile, *settings):
+    """Key of a result for a level1 file, which changes with the file"""
+    stat = os.stat(infile)
+    sha = hashlib.sha1()
+    sha.update(repr(
+        (os.path.abspath(infile), stat.st_size, stat.st_mtime) + settings
+    ))
+    return sha.hexdigest()
+
+
+def cached(cache, key, suffix, compute, load, save):
+    """Load a result from cache, computing and saving it if missing"""
+    if cache is None:
+        return compute()
+    cache_file = os.path.join(cache, key + suffix)
+    if os.path.exists(cache_file):
+        return load(cache_file)
+    result = compute()
+    tmp_file = '{0}.{1}{2}'.format(cache_file, os.getpid(), suffix)
+    save(tmp_file, result)
+    os.rename(tmp_file, cache_file)
+    return result
+
+
+def load_json(filename):
+    """Load a cached json result"""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_json(filename, result):
+    """Save a json result to cache"""
+    with open(filename, 'w') as f:
+        json.dump(result, f)
+
+
+def file_range(args):
+    """Smallest and largest selected charge of a level1 file"""
+    infile, where, cache = args
+    def compute():
+        low, high = np.inf, -np.inf
+        for charges in iter_charges([infile], where):
+            if len(charges):
+                low = min(low, float(np.min(charges)))
+                high = max(high, float(np.max(charges)))
+        return [low, high]
+    return cached(
+        cache, cache_key(infile, where), '.json', compute, load_json,
+        save_json
+    )
+
+
+def file_histogram(args):
+    """Charge histogram of a level1 file"""
+    infile, bins, where, charge_range, cache = args
+    return cached(
+        cache, cache_key(infile, bins, where, tuple(charge_range)), '.npy',
+        lambda: charge_histogram([infile], bins, where, charge_range)[0],
+        np.load, np.save
+    )
+
+
+def run(infiles, outfile, bins, charge_range=None, where=None,
+        mode='overlay', table=None, jobs=1, cache=None, model='gauss',
+        fit_method='lsq'):
+    """Main function to compare the charge histograms
+
+    The histogram of each file is computed in a pool of jobs processes and
+    cached in cache, keyed by the file, its size and modification time, the
+    binning and the query, so that only new or changed files are read
+    again. Returns the table of the fits of model, one row per file, and
+    one for all of them in combined mode.
+    """
+    if cache is not None:
+        try:
+            os.makedirs(cache, mode=0755)
+        except OSError as err:
+            pass
+    pool = Pool(jobs) if jobs > 1 else None
+    mapper = pool.map if pool else map
+    try:
+        if charge_range is None:
+            ranges = mapper(
+                file_range, [(infile, where, cache) for infile in infiles]
+            )
+            charge_range = (
+                min(r[0] for r in ranges), max(r[1] for r in ranges)
+            )
+            if charge_range[0] > charge_range[1]:
+                raise AssertionError('No waveforms selected')
+        hists = mapper(file_histogram, [
+            (infile, bins, where, charge_range, cache) for infile in infiles
+        ])
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    binning = np.linspace(charge_range[0], charge_range[1], bins+1)
+    labels = [os.path.splitext(infile)[0] for infile in infiles]
+    if mode == 'combined':
+        hists = hists + [np.sum(hists, axis=0)]
+        labels = labels + ['combined']
+    fits = fit_engine.fit_spectra(
+        hists, binning, model, fit_method,
+        index=pd.Index(labels, name='file')
+    )
+    print fits.to_string()
+    if table is not None:
+        fits.to_csv(table)
+
+    fig = plt.figure(figsize=(12, 8))
+    ax = fig.add_subplot(111)
+
+    print 'plotting...'
+    ax.set_xlim(binning[0], binning[-1])
+    x = np.linspace(binning[0], binning[-1], 10 * bins + 1)
+    if mode == 'combined':
+        hists = hists[-1:]
+        labels = labels[-1:]
+    for hist, label in zip(hists, labels):
+        hist_0 = np.concatenate([[hist[0]], hist])
+        line, = ax.step(
+            binning, hist_0, alpha=1, drawstyle='steps-pre', linewidth=1,
+            linestyle='-', label=label
+        )
+        fit = fits.loc[label]
+        if fit['success']:
+            ax.plot(
+                x, fit_engine.evaluate(fit, x, binning, model),
+                linestyle='--', color=line.get_color()
+            )
+
+    ax.set_xlabel('Charge (nVs)')
+    ax.set_ylabel('N')
+
+    for ymaj in ax.yaxis.get_majorticklocs():
+        ax.axhline(y=ymaj, ls=':', color='gray', alpha=0.7, linewidth=1)
+    for xmaj in ax.xaxis.get_majorticklocs():
+        ax.axvline(x=xmaj, ls=':', color='gray', alpha=0.7, linewidth=1)
+
+    ax.legend()
+    if mode == 'combined' and fits['success'].iloc[-1]:
+        fit = fits.iloc[-1]
+        if model == 'gauss':
+            text = r'$\mu = {0:.3f}$'.format(fit['mu']) + '\n' + \
+                r'$\sigma = {0:.3f}$'.format(fit['sigma'])
+        else:
+            text = r'$q_0 = {0:.3f}$'.format(fit['q0']) + '\n' + \
+                r'$q_1 = {0:.3f}$'.format(fit['q1'])
+        at = AnchoredText(text + '\n' +
+                          r'$PE = {0:.1f}$'.format(fit['pe']) + '\n' +
+                          r'gain = {0:.2e}'.format(fit['gain']),
+                          prop=dict(size=12), frameon=True, loc=5)
+        at.patch.set_boxstyle("round,pad=0.3,rounding_size=0.2")
+        ax.add_artist(at)
+
+    fig.savefig(outfile, bbox_inches='tight', dpi=150)
+    return fits
+
+
+def main():
+    args = parse_args()
+    run(
+        infiles = args.infiles,
+        outfile = args.outfile,
+        bins = args.bins,
+        charge_range = args.range,
+        where = args.where,
+        mode = args.mode,
+        table = args.table,
+        jobs = args.jobs,
+        cache = args.cache,
+        model = args.model,
+        fit_method = args.fit_method
+    )
+
+    print '=========='
+    print 'DONE'
+    print '=========='
+
+
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python2
+"""
+Fitting of DDC2 charge spectra.
+"""
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit, minimize
+from scipy.signal import find_peaks
+from scipy.special import gammaln
+
+
+MODELS = ['gauss', 'multi_pe']
+METHODS = ['lsq', 'ml']
+
+PARAMS = {
+    'gauss': ['A', 'mu', 'sigma'],
+    'multi_pe': ['n', 'lam', 'q0', 's0', 'q1', 's1']
+}
+BOUNDS = {
+    'gauss': ([-np.inf] * 3, [np.inf] * 3),
+    'multi_pe': (
+        [0., 1e-3, -np.inf, 1e-6, 1e-6, 1e-6],
+        [np.inf, np.inf, np.inf, np.inf, np.inf, np.inf]
+    )
+}
+
+# internal impedence of DDC2 is 150 ohms
+IMPEDANCE = 150.
+ELECTRON_CHARGE = 1.6e-19
+
+
+def gauss(x, *p):
+    """Gaussian of amplitude A, mean mu and width sigma"""
+    A, mu, sigma = p
+    return A*np.exp(-(x-mu)**2/(2.*sigma**2))
+
+
+def n_peaks(lam):
+    """Number of photoelectron peaks, including the pedestal, to model"""
+    return int(np.ceil(lam + 5. * np.sqrt(lam) + 3.))
+
+
+def multi_pe(x, n, lam, q0, s0, q1, s1, width=1., npeaks=None):
+    """Pedestal plus n-PE spectrum of n waveforms, in counts per bin
+
+    The number of photoelectrons is Poisson distributed with mean lam and
+    the charge of k of them gaussian around q0 + k*q1 with variance
+    s0^2 + k*s1^2. All peaks are evaluated at once over a (len(x), npeaks)
+    grid.
+    """
+    if npeaks is None:
+        npeaks = n_peaks(lam)
+    k = np.arange(npeaks)
+    pmf = np.exp(k * np.log(lam) - lam - gammaln(k + 1))
+    mean = q0 + k * q1
+    sigma = np.sqrt(s0**2 + k * s1**2)
+    x = np.asarray(x, dtype=float)[:, None]
+    peaks = np.exp(-(x - mean)**2 / (2. * sigma**2)) / (
+        np.sqrt(2. * np.pi) * sigma
+    )
+    return n * width * peaks.dot(pmf)
+
+
+def model_function(model, width, p0):
+    """Function of (x, *params) to fit for a model"""
+    if model == 'gauss':
+        return gauss
+    elif model == 'multi_pe':
+        # keep the number of peaks fixed during the fit
+        npeaks = n_peaks(2. * p0[1])
+        return lambda x, *p: multi_pe(x, *p, width=width, npeaks=npeaks)
+    raise ValueError('Unknown model {0}'.format(model))
+
+
+def initial_guess(hist, bin_centres, model):
+    """Starting parameters from the moments and peaks of the histogram
+
+    For the multi_pe model the pedestal is the first peak found. The
+    photoelectron charge is the distance to the second peak when it agrees
+    with the mean of the histogram, or else comes from its excess variance
+    over the pedestal.
+    """
+    hist = np.asarray(hist, dtype=float)
+    width = bin_centres[1] - bin_centres[0]
+    mean = np.average(bin_centres, weights=hist)
+    var = np.average((bin_centres - mean)**2, weights=hist)
+    if model == 'gauss':
+        return [np.max(hist), mean, np.sqrt(var)]
+
+    smooth = np.convolve(hist, np.ones(3) / 3., mode='same')
+    peaks, _ = find_peaks(smooth, prominence=max(0.05 * np.max(smooth), 1.))
+    ipeak = peaks[0] if len(peaks) else np.argmax(smooth)
+    q0 = bin_centres[ipeak]
+    # pedestal width from the bins on its lower side
+    low = hist[:ipeak+1]
+    s0 = width
+    if low.sum() > 1:
+        s0 = max(np.sqrt(np.average(
+            (bin_centres[:ipeak+1] - q0)**2, weights=low
+        )), width)
+    excess = max(mean - q0, width)
+    q1 = max((var - s0**2) / (1.09 * excess), width)
+    if len(peaks) > 1:
+        spacing = bin_centres[peaks[1]] - q0
+        if 0.5 < spacing / q1 < 2.:
+            q1 = spacing
+    lam = max(excess / q1, 0.1)
+    return [np.sum(hist), lam, q0, s0, q1, 0.3 * q1]
+
+
+def degenerate(popt, model, width):
+    """Whether a converged fit is not a measurement of the spectrum
+
+    That is when a parameter ends on one of its bounds or, for the
+    multi_pe model, the photoelectron charge is smaller than a bin or than
+    the width of the pedestal and single PE peaks together. The peaks are
+    then not resolved and the fit trades q1 against lam.
+    """
+    low, high = [np.asarray(bound, dtype=float) for bound in BOUNDS[model]]
+    on_bound = np.isclose(popt, low, rtol=1e-6, atol=1e-12) | \
+        np.isclose(popt, high, rtol=1e-6, atol=1e-12)
+    if np.any(on_bound):
+        return True
+    if model == 'multi_pe':
+        params = dict(zip(PARAMS[model], popt))
+        return params['q1'] < max(
+            width, np.hypot(params['s0'], params['s1'])
+        )
+    return False
+
+
+def derived(params, model):
+    """Number of photoelectrons and gain from the fitted parameters"""
+    if model == 'gauss':
+        mu, sigma = params['mu'], abs(params['sigma'])
+        pe = (mu / sigma)**2
+        gain = (mu * 1e-9) / (pe * IMPEDANCE * ELECTRON_CHARGE)
+    else:
+        pe = params['lam']
+        gain = (params['q1'] * 1e-9) / (IMPEDANCE * ELECTRON_CHARGE)
+    return pe, gain
+
+
+def poisson_errors(func, x, p):
+    """Errors of a binned maximum likelihood fit from the Fisher information
+
+    The derivatives of the expected counts with respect to the parameters
+    are taken numerically, all bins at once for each parameter.
+    """
+    p = np.asarray(p, dtype=float)
+    expected = np.maximum(func(x, *p), 1e-300)
+    jac = np.empty((len(x), len(p)))
+    for i in range(len(p)):
+        step = 1e-6 * max(abs(p[i]), 1e-3)
+        high, low = p.copy(), p.copy()
+        high[i] += step
+        low[i] -= step
+        jac[:, i] = (func(x, *high) - func(x, *low)) / (2. * step)
+    fisher = jac.T.dot(jac / expected[:, None])
+    return np.sqrt(np.diag(np.linalg.inv(fisher)))
+
+
+def fit_spectrum(hist, binning, model='gauss', method='lsq', p0=None):
+    """Fit a model to a charge histogram with bin edges binning in nVs
+
+    'lsq' is a least squares fit with Poisson errors on the bins, 'ml' a
+    binned maximum likelihood fit with errors from poisson_errors. p0
+    defaults to initial_guess. Returns a Series holding the parameters and
+    their errors, the number of photoelectrons, the gain, the chi2 and ndf
+    of the fit and whether it succeeded, which it has not if it converged
+    to a degenerate solution.
+    """
+    hist = np.asarray(hist, dtype=float)
+    bin_centres = (binning[:-1] + binning[1:]) / 2.
+    width = binning[1] - binning[0]
+    names = PARAMS[model]
+    result = pd.Series(np.nan, index=(
+        names + ['err_' + name for name in names] +
+        ['pe', 'gain', 'chi2', 'ndf', 'n_wf', 'success']
+    ))
+    result['n_wf'] = np.sum(hist)
+    result['success'] = False
+    if np.count_nonzero(hist) < len(names):
+        return result
+    try:
+        if p0 is None:
+            p0 = initial_guess(hist, bin_centres, model)
+        func = model_function(model, width, p0)
+        if method == 'lsq':
+            popt, pcov = curve_fit(
+                func, bin_centres, hist, p0=p0,
+                sigma=np.sqrt(np.maximum(hist, 1.)), absolute_sigma=True,
+                bounds=BOUNDS[model], maxfev=10000
+            )
+            errors = np.sqrt(np.diag(pcov))
+            success = True
+        elif method == 'ml':
+            def nll(p):
+                mu = np.maximum(func(bin_centres, *p), 1e-300)
+                return np.sum(mu - hist * np.log(mu))
+            bounds = [
+                (None if np.isinf(low) else low,
+                 None if np.isinf(high) else high)
+                for low, high in zip(*BOUNDS[model])
+            ]
+            res = minimize(nll, p0, method='L-BFGS-B', bounds=bounds)
+            popt = res.x
+            errors = poisson_errors(func, bin_centres, popt)
+            success = res.success
+        else:
+            raise ValueError('Unknown fit method {0}'.format(method))
+    except (RuntimeError, ValueError, np.linalg.LinAlgError):
+        return result
+
+    if model == 'gauss':
+        popt[2] = abs(popt[2])
+    params = dict(zip(names, popt))
+    expected = func(bin_centres, *popt)
+    for name, value, error in zip(names, popt, errors):
+        result[name] = value
+        result['err_' + name] = error
+    result['pe'], result['gain'] = derived(params, model)
+    result['chi2'] = np.sum((hist - expected)**2 / np.maximum(hist, 1.))
+    result['ndf'] = np.count_nonzero(hist) - len(names)
+    result['success'] = success and not degenerate(popt, model, width)
+    return result
+
+
+def fit_spectra(hists, binning, model='gauss', method='lsq', index=None):
+    """Fit many histograms with the same binning, one row per histogram"""
+    fits = pd.DataFrame(
+        [fit_spectrum(hist, binning, model, method) for hist in hists],
+        index=index
+    )
+    return fits.astype(dict(
+        (column, bool if column == 'success' else float)
+        for column in fits.columns
+    ))
+
+
+def evaluate(result, x, binning, model):
+    """The fitted model of a fit_spectrum result at x, in counts per bin"""
+    names = PARAMS[model]
+    p = [result[name] for name in names]
+    if model == 'gauss':
+        return gauss(x, *p)
+    return multi_pe(x, *p, width=binning[1] - binning[0])
@@ -3,14 +3,60 @@
 Level 1 processing for DDC2 level0 data.
 """
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import Counter, namedtuple
+import cPickle as pickle
 import gzip
-from io import StringIO
+import hashlib
+from itertools import chain, imap, islice
+from multiprocessing import Pool
 import numpy as np
 import os
 import pandas as pd
-import scipy.interpolate as interpolate
 import time
 
+import baseline as baseline_engine
+import charge as charge_engine
+import pulse as pulse_engine
+
+
+SEPARATOR = '-' * 99
+SAMPLE_COLUMNS = ['isamp', 'adc', 'time', 'tot', 'eoe']
+BATCH_SIZE = 1024
+# LSB = 0.220 mV/ADC count
+LSB = 0.220
+# Internal clock of DDC2 is at 250 MHz (4ns)
+CLOCK = 4
+WF_COLUMNS = [
+    'fpga_ts', 'local_time', 'timestamp', 'charge', 'charge_raw', 'baseline'
+] + pulse_engine.FEATURES
+# Columns of the level1 'wf' table which can be queried with select
+WF_DATA_COLUMNS = ['timestamp', 'charge']
+FLUSH_EVERY = 10000
+COMPLIBS = ['zlib', 'lzo', 'bzip2', 'blosc']
+
+L0Waveform = namedtuple(
+    'L0Waveform',
+    ['header', 'footer', 'fpga_ts', 'local_time', 'nsamples', 'samples']
+)
+
+# Binary level0 format: a flat array of samples per chunk, plus an index with
+# one record per waveform pointing into it
+L0_SAMPLE_DTYPE = np.dtype([
+    ('isamp', '<i2'), ('adc', '<i2'), ('time', '<u2'), ('tot', '<u2'),
+    ('eoe', 'u1')
+])
+L0_INDEX_DTYPE = np.dtype([
+    ('header', '<u4'), ('footer', '<u4'), ('fpga_ts', '<i8'),
+    ('local_time', '<i8'), ('nsamples', '<i4'), ('offset', '<i8'),
+    ('length', '<i4')
+])
+L0_HEADER_FILE = 'level0_header.txt'
+# Metadata saved next to each level0 chunk by record_raw, e.g. what zero
+# suppression rejected from it
+L0_META_SUFFIX = '.meta.json'
+# Seek index of the text level0 chunks of a run, see seek.py
+L0_SEEK_FILE = 'level0_seek.npz'
+
 
 def parse_args():
     """Get command line arguments"""
@@ -30,6 +76,68 @@ def parse_args():
         '--no-invert', action='store_true', default=False,
         required=False, help='''Don't invert the waveform'''
     )
+    parser.add_argument(
+        '--charge-method', type=str, default='spline',
+        choices=charge_engine.METHODS, required=False,
+        help='''Method used to integrate the charge'''
+    )
+    parser.add_argument(
+        '--window', type=int, nargs=2, default=None, metavar='INT',
+        required=False,
+        help='''First and last sample of the charge integration window'''
+    )
+    parser.add_argument(
+        '--baseline-method', type=str, default='global',
+        choices=baseline_engine.METHODS, required=False,
+        help='''Baseline to correct the charge of each waveform with: the
+        global DDC2 baseline, the mean or median of its pre-trigger samples,
+        or the running mean of that over --baseline-window waveforms'''
+    )
+    parser.add_argument(
+        '--pre-config', type=int, default=0,
+        choices=sorted(baseline_engine.PRE_CONFIG_SAMPLES), required=False,
+        help='''AF_SET_PRE_CONFIG setting of the run, giving the number of
+        pre-trigger samples used for the baseline (0: 64, 1: 16, 2: 32, 3: 64,
+        4: 128)'''
+    )
+    parser.add_argument(
+        '--cfd-fraction', type=float, default=0.2, metavar='FLOAT',
+        required=False,
+        help='''Fraction of the amplitude at which the constant fraction time
+        of each pulse is taken'''
+    )
+    parser.add_argument(
+        '--tot-threshold', type=float, default=5., metavar='FLOAT',
+        required=False,
+        help='''Threshold of the time over threshold of each pulse in mV'''
+    )
+    parser.add_argument(
+        '--baseline-window', type=int, default=100, metavar='INT',
+        required=False,
+        help='''Number of waveforms of the running baseline'''
+    )
+    parser.add_argument(
+        '--flush-every', type=int, default=FLUSH_EVERY, metavar='INT',
+        required=False,
+        help='''Number of waveforms to write to the output at a time'''
+    )
+    parser.add_argument(
+        '--complevel', type=int, default=5, choices=range(10),
+        required=False, help='''Compression level of the output, 0 for none'''
+    )
+    parser.add_argument(
+        '--complib', type=str, default='zlib', choices=COMPLIBS,
+        required=False, help='''Compression library of the output'''
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='INT', required=False,
+        help='''Number of processes to share the level0 chunks between'''
+    )
+    parser.add_argument(
+        '--cache', type=str, default=None, metavar='FOLDER', required=False,
+        help='''Folder to cache the level1 result of each level0 chunk in, so
+        that re-runs only process new or changed chunks'''
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true', default=False,
         help='''Verbose'''
@@ -52,104 +160,647 @@ def mk_time(timestamp_list):
     return time.mktime((year, month, day, hour, mins, sec, 0, 0, 0)) + decimal
 
 
-def run(input_folder, outfile, no_invert, verbose):
-    """Main function to perform level1 processing"""
+def l0_files(input_folder):
+    """List the level0 files of a run in the order they were recorded
 
-    l0_data = ''
+    Binary chunks are used in preference to text ones when a run was
+    recorded in both formats.
+    """
+    l0_gz = []
+    l0_dump = []
+    l0_bin = []
     for filename in sorted(os.listdir(input_folder)):
-        if '.txt.gz' not in filename:
-            if 'dump_' in filename and '.txt' in filename:
-                continue
-            print 'Skipping file {0}'.format(filename)
+        if filename.endswith('.bin'):
+            l0_bin.append(filename)
+        elif '.txt.gz' in filename:
+            l0_gz.append(filename)
+        elif 'dump_' in filename and '.txt' in filename:
+            l0_dump.append(filename)
+        elif filename.endswith(('.idx.npy', L0_META_SUFFIX)) or \
+                filename in (L0_HEADER_FILE, L0_SEEK_FILE):
             continue
-        with gzip.open(input_folder+'/'+filename, 'rb') as f:
-            l0_data_raw = f.read()
-        l0_data += l0_data_raw
-    for filename in sorted(os.listdir(input_folder)):
-        if 'dump_' in filename and '.txt' in filename:
-            with open(input_folder+'/'+filename, 'r') as f:
-                l0_data_raw = f.read()
-            l0_data += l0_data_raw
-    l0_data = l0_data.split('---------------------------------------------------------------------------------------------------')
-    if verbose: print 'Number of waveforms = {0}'.format(len(l0_data))
-
-    baseline = int(l0_data[0].split('\n')[0].rstrip().split(' ')[-1])
-    if verbose: print 'Baseline = {0}'.format(baseline)
-    l0_data[0] = l0_data[0][l0_data[0].index('\n')+1:]
+        else:
+            print 'Skipping file {0}'.format(filename)
+    if l0_bin:
+        return [os.path.join(input_folder, f) for f in l0_bin]
+    return [os.path.join(input_folder, f) for f in l0_gz + l0_dump]
 
-    initial_st_ts = l0_data[0].split('\n')[0].rstrip().split(' ')[-2:]
-    initial_mk_ts = mk_time(initial_st_ts)
-    if verbose: print 'Initial mktime = {0}'.format(initial_mk_ts)
-    l0_data[0] = l0_data[0][l0_data[0].index('\n')+1:]
 
-    l1_df = []
-    initial_fpga_ts = None
-    for wf_str in l0_data:
-        wf_arr = wf_str.split('\n')
-        if 'start timestamp' not in wf_arr[5]:
-            raise AssertionError('timestamp not found')
-        if 'local time' not in wf_arr[6]:
-            raise AssertionError('local time not found')
-        if 'Nsamples' not in wf_arr[8]:
-            raise AssertionError('NSamples not found')
-        fpga_ts = int(wf_arr[5].split('=')[1].strip().split(',')[0])
-        local_time = int(wf_arr[6].split('=')[1].strip().split(',')[0])
-        Nsamples = int(wf_arr[8].rstrip().split(' ')[-1])
-        if verbose: print 'timestamp = {0}'.format(fpga_ts)
-        if verbose: print 'local_time = {0}'.format(local_time)
-        if verbose: print 'Nsamples = {0}'.format(Nsamples)
+def l0_open(filename):
+    """Open a level0 file, decompressing it if needed"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'r')
+
+
+def l0_lines(filenames):
+    """Stream the lines of the level0 files one at a time"""
+    for filename in filenames:
+        with l0_open(filename) as f:
+            for line in f:
+                yield line
+
+
+def read_header(filename):
+    """Read the baseline and initial timestamp from the start of a run"""
+    if filename.endswith('.bin'):
+        filename = os.path.join(os.path.dirname(filename), L0_HEADER_FILE)
+    baseline = None
+    initial_mk_ts = None
+    with l0_open(filename) as f:
+        for line in islice(f, 2):
+            if line.startswith('BASELINE'):
+                baseline = int(line.rstrip().split(' ')[-1])
+            elif line.startswith('INITIAL TIMESTAMP'):
+                initial_mk_ts = mk_time(line.rstrip().split(' ')[-2:])
+    if baseline is None:
+        raise AssertionError('baseline not found')
+    if initial_mk_ts is None:
+        print 'Initial timestamp not found, using 0'
+        initial_mk_ts = 0.
+    return baseline, initial_mk_ts
+
+
+class L0Parser(object):
+    """Incremental parser of level0 lines into one record per waveform
+
+    Lines are fed one at a time, as they come from nios2-terminal or a level0
+    file, and feed returns the waveform completed by the line, if any. Only
+    the lines of the waveform being parsed are held in memory. Waveforms
+    whose header was not recorded (e.g. the first one of a run) are skipped.
+    """
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        """Start parsing a new waveform"""
+        self.header, self.footer = 0, 0
+        self.fpga_ts, self.local_time, self.nsamples = None, None, None
+        self.samples = []
+
+    def feed(self, line):
+        """Parse a single line"""
+        if line.count(',') == 5:
+            self.samples.append(line)
+        elif line.startswith(SEPARATOR):
+            return self.flush()
+        elif 'start timestamp' in line:
+            self.fpga_ts = int(line.split('=')[1].strip().split(',')[0])
+        elif 'local time' in line:
+            self.local_time = int(line.split('=')[1].strip().split(',')[0])
+        elif 'Nsamples' in line:
+            self.nsamples = int(line.rstrip().split(' ')[-1])
+        elif line.startswith('header:'):
+            self.header = int(line.split()[1], 16)
+        elif line.startswith('footer:'):
+            self.footer = int(line.split()[1], 16)
+        return None
+
+    def flush(self):
+        """Return the waveform being parsed, if any, and start a new one"""
+        wf = None
+        if None not in (self.fpga_ts, self.local_time, self.nsamples):
+            wf = L0Waveform(
+                self.header, self.footer, self.fpga_ts, self.local_time,
+                self.nsamples, self.samples
+            )
+        elif self.samples and self.verbose:
+            print 'skipping waveform without header'
+        self.reset()
+        return wf
+
+
+def iter_waveforms(lines, verbose=False):
+    """Parse a stream of level0 lines into one record per waveform"""
+    parser = L0Parser(verbose)
+    for line in lines:
+        wf = parser.feed(line)
+        if wf is not None:
+            yield wf
+    wf = parser.flush()
+    if wf is not None:
+        yield wf
+
+
+def iter_batches(waveforms, size):
+    """Group a stream of waveform records into lists of at most size"""
+    batch = []
+    for wf in waveforms:
+        batch.append(wf)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
+
+def decode_samples(waveforms):
+    """Decode the sample lines of a batch of waveforms in a single pass
+
+    Returns an integer array with one row per sample line and the
+    SAMPLE_COLUMNS as columns, together with the offsets of each waveform
+    into it, i.e. waveform i spans rows[offsets[i]:offsets[i+1]].
+    """
+    block = ''.join(chain.from_iterable(wf.samples for wf in waveforms))
+    rows = np.fromstring(block.replace(',', ' '), dtype=int, sep=' ')
+    counts = [len(wf.samples) for wf in waveforms]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if rows.size != offsets[-1] * len(SAMPLE_COLUMNS):
+        raise AssertionError('Could not decode the sample lines')
+    return rows.reshape(-1, len(SAMPLE_COLUMNS)), offsets
+
+
+def binary_index(filename):
+    """Path of the index of a binary level0 chunk"""
+    return os.path.splitext(filename)[0] + '.idx.npy'
+
+
+def write_binary(filename, waveforms):
+    """Write waveform records to a binary level0 chunk
+
+    The samples of all the waveforms are written to filename as one flat
+    array of L0_SAMPLE_DTYPE, which can be memory mapped, and the index with
+    an L0_INDEX_DTYPE record per waveform is saved next to it.
+    """
+    if waveforms:
+        rows, offsets = decode_samples(waveforms)
+    else:
+        rows, offsets = np.empty((0, len(SAMPLE_COLUMNS))), np.zeros(1)
+    samples = np.empty(len(rows), dtype=L0_SAMPLE_DTYPE)
+    for idx, name in enumerate(SAMPLE_COLUMNS):
+        samples[name] = rows[:, idx]
+    index = np.empty(len(waveforms), dtype=L0_INDEX_DTYPE)
+    for name in ['header', 'footer', 'fpga_ts', 'local_time', 'nsamples']:
+        index[name] = [getattr(wf, name) for wf in waveforms]
+    index['offset'] = offsets[:-1]
+    index['length'] = np.diff(offsets)
+    samples.tofile(filename)
+    np.save(binary_index(filename), index)
+
+
+def read_binary(filename):
+    """Memory map a binary level0 chunk, returning its index and samples"""
+    index = np.load(binary_index(filename))
+    if os.path.getsize(filename) == 0:
+        return index, np.empty(0, dtype=L0_SAMPLE_DTYPE)
+    return index, np.memmap(filename, dtype=L0_SAMPLE_DTYPE, mode='r')
+
+
+def run_nsamples(lengths):
+    """Nsamples of a run, from the counts of its complete waveforms by length
+
+    This is the most common length, the longest of those if there is a tie,
+    so it does not depend on which waveform comes first.
+    """
+    if not lengths:
+        raise AssertionError('No complete waveforms found')
+    return max(lengths, key=lambda n: (lengths[n], n))
+
+
+def read_run_start(filenames):
+    """Find the initial FPGA timestamp and Nsamples of a run
+
+    All the waveform records are scanned to find Nsamples, see run_nsamples.
+    Also returns the numbers of incomplete waveforms and of complete ones of
+    another length, which l1 skips.
+    """
+    if filenames[0].endswith('.bin'):
+        records = chain.from_iterable(
+            np.load(binary_index(f)) for f in filenames
+        )
+        records = (
+            (r['fpga_ts'], r['nsamples'], r['length']) for r in records
+        )
+    else:
+        records = (
+            (wf.fpga_ts, wf.nsamples, len(wf.samples))
+            for wf in iter_waveforms(l0_lines(filenames))
+        )
+    initial_fpga_ts = None
+    lengths = Counter()
+    n_incomplete = 0
+    for fpga_ts, nsamples, length in records:
         if initial_fpga_ts is None:
-            initial_fpga_ts = fpga_ts
-            if verbose: print 'Initial FPGA timestamp {0}'.format(initial_fpga_ts)
-
-        index = range(Nsamples)
-        columns = ['isamp', 'adc', 'timestamp']
-        wv_data = np.loadtxt(
-            StringIO(u'{0}'.format(reduce(lambda x,y: x+'\n'+y, wf_arr[11:]))),
-            dtype=int,
-            delimiter=',',
-            usecols=(0, 1, 2)
+            initial_fpga_ts = int(fpga_ts)
+        if length == nsamples:
+            lengths[int(nsamples)] += 1
+        else:
+            n_incomplete += 1
+    nsamples = run_nsamples(lengths)
+    skipped = {
+        'incomplete': n_incomplete,
+        'other_nsamples': sum(lengths.values()) - lengths[nsamples]
+    }
+    return initial_fpga_ts, nsamples, skipped
+
+
+def corrected_charge(charge_raw, local_baseline, baseline, no_invert,
+                     weight_sum):
+    """Charge integrated around the global baseline moved to a local one
+
+    The integral is linear in the samples, so shifting the baseline by d ADC
+    counts shifts the charge by d times the sum of the quadrature weights.
+    """
+    shift = (local_baseline - baseline) * weight_sum * LSB / 1e3
+    if not no_invert:
+        return charge_raw + shift
+    return charge_raw - shift
+
+
+def set_features(wf, adc, baseline, no_invert, cfd_fraction, tot_threshold):
+    """Set the pulse features of wf around the baseline column of wf
+
+    adc is taken around the global baseline, as returned by l1_part. The
+    amplitude is in mV and the times in ns from the first sample.
+    """
+    shift = wf['baseline'].values - baseline
+    features = pulse_engine.features(
+        adc + (-shift if no_invert else shift)[:, None], CLOCK, cfd_fraction,
+        tot_threshold / LSB
+    )
+    for name in pulse_engine.FEATURES:
+        wf[name] = features[name]
+    wf['amplitude'] *= LSB
+
+
+def l1_part(adc, info, baseline, no_invert, charge_method, window,
+            baseline_method='global', pre_samples=64, cfd_fraction=0.2,
+            tot_threshold=5.):
+    """Level1 processing of the raw ADC matrix of a set of waveforms
+
+    info holds the FPGA timestamp, local time and time of the first sample
+    of each waveform. Returns the ADC matrix and the per-waveform table,
+    indexed from zero. The timestamps are only set once the partial results
+    of a run are indexed by index_l1. The ADC matrix and charge_raw are taken
+    around the global baseline, charge around the baseline of each waveform.
+    The pulse features are taken around the baseline of each waveform too,
+    see set_features.
+    """
+    if baseline_method == 'global':
+        local_baseline = np.full(len(adc), baseline)
+    else:
+        local_baseline = baseline_engine.estimate(
+            adc, pre_samples, baseline_method
         )
-        if len(wv_data) != Nsamples:
-            if verbose: print 'skipping incomplete waveform'
+    if not no_invert:
+        # invert in y axis and renormalise to baseline
+        adc = baseline - adc
+    else:
+        # renormalise to baseline
+        adc = adc - baseline
+    adc = adc.astype(np.int16)
+    wf = pd.DataFrame(
+        np.asarray(info, dtype=np.int64).reshape(-1, 3),
+        columns=['fpga_ts', 'local_time', 'start_time']
+    )
+    # convert to nVs
+    wf['charge_raw'] = charge_engine.integrate(
+        adc, CLOCK, charge_method, window
+    ) * LSB / 1e3
+    wf['baseline'] = local_baseline
+    wf['charge'] = wf['charge_raw']
+    set_features(wf, adc, baseline, no_invert, cfd_fraction, tot_threshold)
+    if baseline_method != 'global':
+        weight_sum = charge_engine.quadrature_weights(
+            adc.shape[1], CLOCK, charge_method,
+            None if window is None else tuple(window)
+        ).sum()
+        wf['charge'] = corrected_charge(
+            wf['charge_raw'].values, local_baseline, baseline, no_invert,
+            weight_sum
+        )
+    return adc, wf
+
+
+def l1_waveforms(waveforms, baseline, nsamples, no_invert, charge_method,
+                 window, verbose, baseline_method='global', pre_samples=64,
+                 cfd_fraction=0.2, tot_threshold=5.):
+    """Level1 processing of a stream of waveform records"""
+    l1_adc = []
+    l1_info = []
+    for batch in iter_batches(waveforms, BATCH_SIZE):
+        rows, offsets = decode_samples(batch)
+        adc = []
+        for wf, start, stop in zip(batch, offsets[:-1], offsets[1:]):
+            if verbose: print 'timestamp = {0}'.format(wf.fpga_ts)
+            if verbose: print 'local_time = {0}'.format(wf.local_time)
+            if verbose: print 'Nsamples = {0}'.format(wf.nsamples)
+
+            if stop - start != wf.nsamples:
+                if verbose: print 'skipping incomplete waveform'
+                continue
+            if wf.nsamples != nsamples:
+                if verbose: print 'skipping waveform with different Nsamples'
+                continue
+            adc.append(rows[start:stop, 1])
+            l1_info.append((wf.fpga_ts, wf.local_time, rows[start, 2]))
+        if adc:
+            l1_adc.append(np.vstack(adc).astype(np.int16))
+
+    if l1_adc:
+        adc = np.concatenate(l1_adc)
+    else:
+        adc = np.empty((0, nsamples), dtype=np.int16)
+    return l1_part(
+        adc, l1_info, baseline, no_invert, charge_method, window,
+        baseline_method, pre_samples, cfd_fraction, tot_threshold
+    )
+
+
+def l1_binary(filename, baseline, nsamples, no_invert, charge_method, window,
+              verbose, baseline_method='global', pre_samples=64,
+              cfd_fraction=0.2, tot_threshold=5.):
+    """Level1 processing of a binary level0 chunk"""
+    index, samples = read_binary(filename)
+    complete = (index['length'] == index['nsamples']) & \
+               (index['nsamples'] == nsamples)
+    if verbose:
+        print 'skipping {0} incomplete waveforms'.format(np.sum(~complete))
+    index = index[complete]
+    adc = samples['adc'][index['offset'][:, None] + np.arange(nsamples)]
+    info = np.column_stack([
+        index['fpga_ts'], index['local_time'],
+        samples['time'][index['offset']]
+    ])
+    return l1_part(
+        adc, info, baseline, no_invert, charge_method, window,
+        baseline_method, pre_samples, cfd_fraction, tot_threshold
+    )
+
+
+def chunk_lines(lines, head, tail):
+    """Yield the lines of the waveforms fully contained in a level0 chunk
+
+    The lines before the first separator are collected in head and those of
+    the last waveform in tail, as they belong to waveforms which may carry
+    on from the previous chunk or into the next one.
+    """
+    for line in lines:
+        if line.startswith(SEPARATOR):
+            tail.append(line)
+            break
+        head.append(line)
+    for line in lines:
+        if line.startswith(SEPARATOR):
+            for wf_line in tail:
+                yield wf_line
+            del tail[:]
+        tail.append(line)
+
+
+def code_version():
+    """Hash of the level1 source code"""
+    sha = hashlib.sha1()
+    for module_file in (__file__, charge_engine.__file__,
+                        baseline_engine.__file__, pulse_engine.__file__):
+        with open(os.path.splitext(module_file)[0] + '.py', 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def chunk_key(filename, params):
+    """Content address of the level1 result of a level0 chunk
+
+    It is built from the contents of the chunk, the level1 parameters and the
+    level1 source code (which holds the LSB and clock), so that a change in
+    any of them invalidates the cached result.
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    settings = sorted((k, v) for k, v in params.items() if k != 'verbose')
+    sha.update(repr(settings))
+    sha.update(code_version())
+    return sha.hexdigest()
+
+
+def l1_chunk(args):
+    """Level1 processing of a single level0 chunk, run by the worker pool"""
+    filename, params, cache = args
+    if cache is not None:
+        cache_file = os.path.join(cache, chunk_key(filename, params) + '.pkl')
+        if os.path.exists(cache_file):
+            if params['verbose']: print 'Using cached {0}'.format(filename)
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+
+    head, tail = [], []
+    if filename.endswith('.bin'):
+        part = l1_binary(filename, **params)
+    else:
+        with l0_open(filename) as f:
+            lines = chunk_lines(f, head, tail)
+            waveforms = iter_waveforms(lines, params['verbose'])
+            part = l1_waveforms(waveforms, **params)
+
+    if cache is not None:
+        tmp_file = '{0}.{1}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((head, tail, part), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, cache_file)
+    return head, tail, part
+
+
+def l1_chunks(filenames, jobs, params, cache=None):
+    """Level1 processing of the level0 chunks one at a time
+
+    With more than one job the chunks are fanned out over a pool of
+    processes. Yields the partial results in recording order, including
+    those of the waveforms spanning two chunks, which are stitched back
+    together here.
+    """
+    if cache is not None:
+        try:
+            os.makedirs(cache, mode=0755)
+        except OSError as err:
+            pass
+    tasks = [(filename, params, cache) for filename in filenames]
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        results = pool.imap(l1_chunk, tasks) if pool else imap(l1_chunk, tasks)
+        carry = []
+        for head, tail, part in results:
+            carry += head
+            if tail:
+                yield l1_waveforms(
+                    iter_waveforms(carry, params['verbose']), **params
+                )
+                carry = tail
+            yield part
+        yield l1_waveforms(iter_waveforms(carry, params['verbose']), **params)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def index_l1(parts, initial_mk_ts, initial_fpga_ts):
+    """Index partial level1 results, in order, as part of the whole run
+
+    Yields the ADC and waveform frames of each part, indexed by the number
+    of the waveform in the run and with their timestamps set.
+    """
+    n_wf = 0
+    for adc, wf in parts:
+        if len(adc) == 0:
             continue
-        # convert to ns
-        wv_data[:,0] *= 4
-        if not no_invert:
-            # invert in y axis
-            wv_data[:,1] = -wv_data[:,1]
-            # renormalise to baseline
-            wv_data[:,1] = wv_data[:,1] + baseline
-        else:
-            # renormalise to baseline
-            wv_data[:,1] = wv_data[:,1] - baseline
-
-        df = pd.DataFrame(wv_data, columns=columns)
-        df = df.assign(index = len(l1_df))
-
-        # LSB = 0.220 mV/ADC count
-        df = df.assign(voltage = df['adc'] * 0.220)
-        # Internal clock of DDC2 is at 250 MHz (4ns)
-        timestamp = initial_mk_ts + 4 * (fpga_ts - initial_fpga_ts +
-                                         df['timestamp'] - local_time)
-        df['timestamp'] = timestamp
-
-        wv_spline = interpolate.splrep(df['isamp'], df['voltage'], s=0)
-        wv_area = interpolate.splint(0, np.max(df['isamp']), wv_spline)
-        # convert to nVs
-        charge = wv_area / 1e3
-        df = df.assign(charge = charge)
-
-        df = df.reindex(index)
-        l1_df.append(df)
-    # l1_df = pd.concat(l1_df, axis=1, keys=range(len(l1_df)))
-    print 'Number of waveforms = {0}'.format(len(l1_df))
-    l1_df = pd.concat(l1_df)
+        index = pd.RangeIndex(n_wf, n_wf + len(adc), name='index')
+        wf['timestamp'] = initial_mk_ts + CLOCK * (
+            wf['fpga_ts'] - initial_fpga_ts +
+            wf['start_time'] - wf['local_time']
+        )
+        yield pd.DataFrame(adc, index=index), wf[WF_COLUMNS].set_index(index)
+        n_wf += len(adc)
+
+
+def running_baseline(frames, baseline_window, baseline, no_invert,
+                     weight_sum, cfd_fraction=0.2, tot_threshold=5.):
+    """Replace the baseline of each waveform by its running mean
+
+    The window carries on from one frame to the next, and the charge and
+    the pulse features are taken again around the smoothed baseline.
+    """
+    history = np.empty(0)
+    for adc, wf in frames:
+        values = np.concatenate([history, wf['baseline'].values])
+        wf['baseline'] = baseline_engine.running_mean(
+            values, baseline_window
+        )[len(history):]
+        wf['charge'] = corrected_charge(
+            wf['charge_raw'].values, wf['baseline'].values, baseline,
+            no_invert, weight_sum
+        )
+        set_features(
+            wf, adc.values, baseline, no_invert, cfd_fraction, tot_threshold
+        )
+        history = values[max(len(values) - baseline_window + 1, 0):]
+        yield adc, wf
+
+
+def append_l1(store, frames, complevel, complib):
+    """Append level1 frames to the tables of store"""
+    store.append(
+        'adc', pd.concat([adc for adc, _ in frames]), index=False,
+        complevel=complevel, complib=complib
+    )
+    store.append(
+        'wf', pd.concat([wf for _, wf in frames]), index=False,
+        data_columns=WF_DATA_COLUMNS, complevel=complevel, complib=complib
+    )
+    store.flush()
+
+
+def write_l1(store, frames, flush_every, complevel=5, complib='zlib'):
+    """Write a stream of level1 frames to store in table format
+
+    The frames are appended every flush_every waveforms, so only that many
+    are held in memory, and the tables are indexed once they are complete.
+    Returns the number of waveforms written.
+    """
+    for key in ('adc', 'wf'):
+        if key in store:
+            store.remove(key)
+    n_wf = 0
+    pending = []
+    n_pending = 0
+    for adc, wf in frames:
+        pending.append((adc, wf))
+        n_pending += len(adc)
+        if n_pending >= flush_every:
+            append_l1(store, pending, complevel, complib)
+            n_wf += n_pending
+            pending = []
+            n_pending = 0
+    if pending:
+        append_l1(store, pending, complevel, complib)
+        n_wf += n_pending
+    if n_wf == 0:
+        raise AssertionError('No complete waveforms found')
+    store.create_table_index('adc', columns=['index'], optlevel=9, kind='full')
+    store.create_table_index(
+        'wf', columns=['index'] + WF_DATA_COLUMNS, optlevel=9, kind='full'
+    )
+    return n_wf
+
+
+def run(input_folder, outfile, no_invert, verbose, charge_method='spline',
+        window=None, jobs=1, cache=None, baseline_method='global',
+        pre_samples=64, baseline_window=100, flush_every=FLUSH_EVERY,
+        complevel=5, complib='zlib', cfd_fraction=0.2, tot_threshold=5.):
+    """Main function to perform level1 processing
+
+    The level1 output holds two compressed tables: 'adc', a dense
+    (n_waveforms, Nsamples) int16 matrix of the baseline subtracted ADC
+    counts, and 'wf', with one row per waveform holding its FPGA timestamp,
+    local time, timestamp, charge and baseline. Both are indexed by the
+    number of the waveform in the run, and the timestamp and charge of 'wf'
+    are indexed data columns, so they can be queried with select. They are
+    written every flush_every waveforms. With a baseline_method other than
+    'global', baseline is estimated for each waveform from its first
+    pre_samples samples and charge is corrected for it, while charge_raw
+    keeps the charge around the global baseline. 'wf' also holds the
+    amplitude, peak sample, 10-90% rise time, FWHM, time over tot_threshold
+    mV and constant fraction time at cfd_fraction of each pulse.
+    """
+
+    filenames = l0_files(input_folder)
+    baseline, initial_mk_ts = read_header(filenames[0])
+    if verbose: print 'Baseline = {0}'.format(baseline)
+    if verbose: print 'Initial mktime = {0}'.format(initial_mk_ts)
+    initial_fpga_ts, nsamples, skipped = read_run_start(filenames)
+    if verbose: print 'Initial FPGA timestamp {0}'.format(initial_fpga_ts)
+    print 'Skipping {0} incomplete waveforms and {1} with Nsamples other ' \
+        'than {2}'.format(
+            skipped['incomplete'], skipped['other_nsamples'], nsamples
+        )
+
+    params = {
+        'baseline': baseline, 'nsamples': nsamples, 'no_invert': no_invert,
+        'charge_method': charge_method,
+        'window': None if window is None else tuple(window),
+        'verbose': verbose, 'baseline_method': baseline_method,
+        'pre_samples': pre_samples, 'cfd_fraction': cfd_fraction,
+        'tot_threshold': tot_threshold
+    }
+    binary = filenames[0].endswith('.bin')
+    if jobs > 1 or cache is not None or binary:
+        parts = l1_chunks(filenames, jobs, params, cache)
+    else:
+        waveforms = iter_waveforms(l0_lines(filenames), verbose)
+        parts = (
+            l1_waveforms(batch, **params)
+            for batch in iter_batches(waveforms, BATCH_SIZE)
+        )
+    frames = index_l1(parts, initial_mk_ts, initial_fpga_ts)
+    if baseline_method == 'running':
+        weight_sum = charge_engine.quadrature_weights(
+            nsamples, CLOCK, charge_method, params['window']
+        ).sum()
+        frames = running_baseline(
+            frames, baseline_window, baseline, no_invert, weight_sum,
+            cfd_fraction, tot_threshold
+        )
 
     store = pd.HDFStore(outfile)
-    store['df'] = l1_df
-    store.close()
+    try:
+        n_wf = write_l1(store, frames, flush_every, complevel, complib)
+        store.get_storer('wf').attrs.metadata = {
+            'baseline': baseline, 'initial_mk_ts': initial_mk_ts,
+            'initial_fpga_ts': initial_fpga_ts, 'nsamples': nsamples,
+            'invert': not no_invert, 'lsb': LSB, 'clock': CLOCK,
+            'charge_method': charge_method,
+            'window': None if window is None else list(window),
+            'baseline_method': baseline_method, 'pre_samples': pre_samples,
+            'baseline_window': baseline_window, 'cfd_fraction': cfd_fraction,
+            'tot_threshold': tot_threshold,
+            'n_incomplete': skipped['incomplete'],
+            'n_other_nsamples': skipped['other_nsamples']
+        }
+    finally:
+        store.close()
+    print 'Number of waveforms = {0}'.format(n_wf)
 
 
 def main():
@@ -157,8 +808,20 @@ def main():
     run(
         input_folder = args.input_folder,
         outfile = args.outfile,
-        invert = args.invert,
-        verbose = args.verbose
+        no_invert = args.no_invert,
+        verbose = args.verbose,
+        charge_method = args.charge_method,
+        window = args.window,
+        jobs = args.jobs,
+        cache = args.cache,
+        baseline_method = args.baseline_method,
+        pre_samples = baseline_engine.PRE_CONFIG_SAMPLES[args.pre_config],
+        baseline_window = args.baseline_window,
+        flush_every = args.flush_every,
+        complevel = args.complevel,
+        complib = args.complib,
+        cfd_fraction = args.cfd_fraction,
+        tot_threshold = args.tot_threshold
     )
 
     print '=========='
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+"""
+Throughput and timing metrics of the DDC2 acquisition.
+"""
+from collections import defaultdict
+import json
+import sys
+from timeit import default_timer as timer
+
+
+class Metrics(object):
+    """Counters, timers and gauges of an acquisition run
+
+    Counters (lines, bytes, waveforms, ...) and timers (seconds spent in
+    readline, parsing, live plotting, ...) are accumulated as the run goes,
+    while gauges hold the last value of e.g. a queue depth. report prints the
+    rates since the previous report to stderr every interval seconds and
+    summary gives the totals of the whole run.
+    """
+    def __init__(self, interval=10.):
+        self.interval = interval
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+        self.gauges = {}
+        self.start = timer()
+        self._last_report = self.start
+        self._last_counters = {}
+
+    def count(self, name, n=1):
+        """Increment a counter"""
+        self.counters[name] += n
+
+    def time(self, name, seconds):
+        """Add to the time spent in a step"""
+        self.timers[name] += seconds
+
+    def gauge(self, name, value):
+        """Set a gauge, keeping track of its maximum"""
+        self.gauges[name] = value
+        self.gauges[name+'_max'] = max(
+            value, self.gauges.get(name+'_max', value)
+        )
+
+    def lines(self, stream):
+        """Iterate over the lines of stream, timing readline"""
+        readline = stream.readline
+        while True:
+            start = timer()
+            line = readline()
+            self.timers['readline'] += timer() - start
+            if not line:
+                return
+            self.counters['lines'] += 1
+            self.counters['bytes'] += len(line)
+            yield line
+
+    def report(self, now=None):
+        """Print the rates since the last report to stderr, every interval"""
+        if not self.interval:
+            return
+        if now is None:
+            now = timer()
+        dt = now - self._last_report
+        if dt < self.interval:
+            return
+        rates = ', '.join(
+            '{0} = {1:.1f}/s'.format(
+                name, (value - self._last_counters.get(name, 0)) / dt
+            ) for name, value in sorted(self.counters.items())
+        )
+        gauges = ''.join(
+            ', {0} = {1}'.format(name, value)
+            for name, value in sorted(self.gauges.items())
+        )
+        sys.stderr.write('[{0:.0f}s] {1}{2}\n'.format(
+            now - self.start, rates, gauges
+        ))
+        self._last_report = now
+        self._last_counters = dict(self.counters)
+
+    def summary(self, outfile=None):
+        """Totals and average rates of the run, also written out as JSON"""
+        elapsed = timer() - self.start
+        summary = {
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'rates': dict(
+                (name, value / elapsed)
+                for name, value in self.counters.items()
+            ),
+            'timers': dict(self.timers),
+            'gauges': dict(self.gauges)
+        }
+        summary_json = json.dumps(summary, indent=2, sort_keys=True)
+        sys.stderr.write(summary_json + '\n')
+        if outfile is not None:
+            with open(outfile, 'w') as f:
+                f.write(summary_json + '\n')
+        return summary
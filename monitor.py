@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+"""
+Online charge spectrum and trigger rate monitor of the DDC2 acquisition.
+"""
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+import charge as charge_engine
+import fit as fit_engine
+from l1 import CLOCK, LSB
+
+
+class ChargeMonitor(object):
+    """Running charge histogram and rates of an acquisition
+
+    add integrates each waveform as it arrives, subtracting the DDC2 baseline
+    and, unless invert is False as with l1 --no-invert, inverting as l1
+    does, and increments a single bin of a histogram
+    with fixed binning, so no waveforms are kept. Charges outside the
+    binning are counted as underflow or overflow, and waveforms with a
+    different number of samples to the first are skipped. Every interval
+    seconds report refits the model of plot_charge to the histogram and
+    prints the PE and gain along with the acquisition and trigger rates to
+    stderr.
+    """
+    def __init__(self, baseline=None, bins=100, charge_range=(0., 100.),
+                 interval=10., method='spline', model='gauss', invert=True):
+        self.baseline = baseline
+        self.binning = np.linspace(charge_range[0], charge_range[1], bins+1)
+        self.bin_centres = (self.binning[:-1] + self.binning[1:]) / 2.
+        self.hist = np.zeros(bins, dtype=int)
+        self.underflow = 0
+        self.overflow = 0
+        self.interval = interval
+        self.method = method
+        self.model = model
+        self.invert = invert
+        self.n_wf = 0
+        self.nsamples = None
+        self.skipped = 0
+        self.fpga_ts = None
+        self.fit = None
+        self.start = timer()
+        self._last_report = self.start
+        self._last_n_wf = 0
+        self._last_fpga_ts = None
+
+    def add(self, adc, fpga_ts):
+        """Add the raw ADC counts of a single waveform"""
+        if self.baseline is None:
+            raise AssertionError('baseline not set')
+        if self.nsamples is None:
+            self.nsamples = len(adc)
+        elif len(adc) != self.nsamples:
+            self.skipped += 1
+            return None
+        weights = charge_engine.quadrature_weights(
+            len(adc), CLOCK, self.method
+        )
+        if self.invert:
+            pulse = self.baseline - np.asarray(adc)
+        else:
+            pulse = np.asarray(adc) - self.baseline
+        charge = np.dot(pulse, weights) * LSB / 1e3
+        ibin = int(np.floor(
+            (charge - self.binning[0]) / (self.binning[1] - self.binning[0])
+        ))
+        if ibin < 0:
+            self.underflow += 1
+        elif ibin >= len(self.hist):
+            self.overflow += 1
+        else:
+            self.hist[ibin] += 1
+        self.n_wf += 1
+        if self._last_fpga_ts is None:
+            self._last_fpga_ts = fpga_ts
+        self.fpga_ts = fpga_ts
+        return charge
+
+    def refit(self):
+        """Fit the model to the histogram, None if the fit fails"""
+        fit = fit_engine.fit_spectrum(self.hist, self.binning, self.model)
+        self.fit = fit if fit['success'] else None
+        return self.fit
+
+    def report(self, now=None, force=False):
+        """Refit and print the monitor to stderr, every interval"""
+        if not self.interval and not force:
+            return
+        if now is None:
+            now = timer()
+        dt = now - self._last_report
+        if dt < self.interval and not force:
+            return
+        n_new = self.n_wf - self._last_n_wf
+        rate = n_new / dt if dt > 0 else 0.
+        trigger_rate = 0.
+        if self.fpga_ts is not None and self.fpga_ts != self._last_fpga_ts:
+            trigger_rate = n_new / (
+                (self.fpga_ts - self._last_fpga_ts) * CLOCK * 1e-9
+            )
+        message = '[{0:.0f}s] N = {1}, rate = {2:.1f} Hz, trigger rate = ' \
+            '{3:.1f} Hz, under/overflow = {4}/{5}'.format(
+                now - self.start, self.n_wf, rate, trigger_rate,
+                self.underflow, self.overflow
+            )
+        fit = self.refit()
+        if fit is not None:
+            if self.model == 'gauss':
+                message += ', mu = {0:.3f} nVs, sigma = {1:.3f} nVs'.format(
+                    fit['mu'], fit['sigma']
+                )
+            else:
+                message += ', q0 = {0:.3f} nVs, q1 = {1:.3f} nVs'.format(
+                    fit['q0'], fit['q1']
+                )
+            message += ', PE = {0:.1f}, gain = {1:.2e}'.format(
+                fit['pe'], fit['gain']
+            )
+        sys.stderr.write(message + '\n')
+        self._last_report = now
+        self._last_n_wf = self.n_wf
+        self._last_fpga_ts = self.fpga_ts
@@ -0,0 +1,298 @@
+#!/usr/bin/env python2
+"""
+Noise spectrum, RMS and baseline of DDC2 noise runs
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import Counter
+from multiprocessing import Pool
+import os
+
+import matplotlib as mpl
+from matplotlib import pyplot as plt
+import numpy as np
+import pandas as pd
+mpl.rcParams['mathtext.fontset'] = 'custom'
+mpl.rcParams['mathtext.rm'] = 'Bitstream Vera Sans'
+mpl.rcParams['mathtext.it'] = 'Bitstream Vera Sans:italic'
+mpl.rcParams['mathtext.bf'] = 'Bitstream Vera Sans:bold'
+
+from l1 import CLOCK, LSB
+from plot_wv import iter_adc
+
+# Number of waveforms to transform at a time
+BLOCK_SIZE = 4096
+# Width of the bins of the baseline and RMS histograms in ADC counts
+BASELINE_BIN = 0.25
+RMS_BIN = 0.05
+
+
+def parse_args():
+    """Get command line arguments"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-i', '--infiles', type=str, nargs='+', metavar='FILE',
+        required=True,
+        help='''Paths to numpy files saved by run.py or level1 files'''
+    )
+    parser.add_argument(
+        '-o', '--outfile', type=str, default='./images/noise.png',
+        metavar='FILE', required=False,
+        help='''Output path of figure'''
+    )
+    parser.add_argument(
+        '--nperseg', type=int, default=None, metavar='INT', required=False,
+        help='''Number of samples of the Welch segments, by default the
+        whole waveform. Shorter segments overlap by half'''
+    )
+    parser.add_argument(
+        '-n', '--nwf', type=int, default=None, metavar='INT',
+        required=False, help='''Number of waveforms to use of each file'''
+    )
+    parser.add_argument(
+        '-t', '--table', type=str, default=None, metavar='FILE',
+        required=False, help='''Save the table of noise figures as csv'''
+    )
+    parser.add_argument(
+        '--psd', type=str, default=None, metavar='FILE', required=False,
+        help='''Save the spectra as csv, one column per file'''
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='INT', required=False,
+        help='''Number of processes to share the files between'''
+    )
+    args = parser.parse_args()
+    return args
+
+
+def iter_blocks(infile, nwf=None, block_size=BLOCK_SIZE):
+    """Stream the ADC counts of a noise run, block_size waveforms at a time
+
+    Numpy files saved by run.py are memory mapped and give the raw ADC
+    counts, level1 files the counts around the global baseline.
+    """
+    if infile.endswith('.npy'):
+        data = np.load(infile, mmap_mode='r')
+        stop = len(data) if nwf is None else min(nwf, len(data))
+        for start in xrange(0, stop, block_size):
+            yield np.asarray(data[start:min(start+block_size, stop), :, 1])
+    else:
+        for adc in iter_adc(infile, nwf, block_size):
+            yield adc
+
+
+class NoiseSpectrum(object):
+    """Welch averaged power spectral density of a stream of noise waveforms
+
+    Each waveform is cut into segments of nperseg samples, overlapping by
+    half, which are detrended by their mean and Hann windowed, and the
+    squared rfft of every segment of a block of waveforms is summed at once.
+    Along with it add keeps running sums of the samples, their squares and
+    the mean and RMS of each waveform, and histograms of those, so that the
+    memory used does not grow with the number of waveforms.
+    """
+    def __init__(self, nsamples, nperseg=None, step=CLOCK):
+        self.nsamples = nsamples
+        self.nperseg = nsamples if nperseg is None else nperseg
+        if not 1 < self.nperseg <= nsamples:
+            raise AssertionError(
+                'nperseg must be between 2 and {0}'.format(nsamples)
+            )
+        stride = max(self.nperseg // 2, 1)
+        self.starts = np.arange(0, nsamples - self.nperseg + 1, stride)
+        self.window = np.hanning(self.nperseg + 2)[1:-1]
+        # sampling frequency in Hz
+        self.fs = 1e9 / step
+        self.freq = np.fft.rfftfreq(self.nperseg, 1. / self.fs)
+        self.power = np.zeros(len(self.freq))
+        self.n_wf = 0
+        self.n_segments = 0
+        self.total = 0.
+        self.total_sq = 0.
+        self.mean_sum = 0.
+        self.mean_sq = 0.
+        self.rms_sum = 0.
+        self.baselines = Counter()
+        self.rms = Counter()
+
+    def add(self, adc):
+        """Add a (n_waveforms, nsamples) block of ADC counts"""
+        adc = np.asarray(adc, dtype=float)
+        if adc.shape[1] != self.nsamples:
+            raise AssertionError('Expected {0} samples, got {1}'.format(
+                self.nsamples, adc.shape[1]
+            ))
+        segments = adc[:, self.starts[:, None] + np.arange(self.nperseg)]
+        segments -= segments.mean(axis=2)[:, :, None]
+        spectra = np.fft.rfft(segments * self.window, axis=2)
+        self.power += (spectra.real**2 + spectra.imag**2).sum(axis=(0, 1))
+        self.n_wf += len(adc)
+        self.n_segments += segments.shape[0] * segments.shape[1]
+        self.total += adc.sum()
+        self.total_sq += (adc**2).sum()
+
+        mean = adc.mean(axis=1)
+        rms = np.sqrt(((adc - mean[:, None])**2).mean(axis=1))
+        self.mean_sum += mean.sum()
+        self.mean_sq += (mean**2).sum()
+        self.rms_sum += rms.sum()
+        for hist, values, width in ((self.baselines, mean, BASELINE_BIN),
+                                    (self.rms, rms, RMS_BIN)):
+            bins, counts = np.unique(
+                np.floor(values / width).astype(np.int64), return_counts=True
+            )
+            hist.update(dict(zip(bins, counts)))
+
+    def psd(self):
+        """One sided power spectral density in mV^2/Hz"""
+        scale = 2. / (self.fs * np.sum(self.window**2) * self.n_segments)
+        psd = self.power * scale * LSB**2
+        # DC and Nyquist are not doubled
+        psd[0] /= 2.
+        if self.nperseg % 2 == 0:
+            psd[-1] /= 2.
+        return psd
+
+    def histogram(self, name):
+        """Bin edges in mV and counts of the 'baseline' or 'rms' histogram"""
+        hist, width = {
+            'baseline': (self.baselines, BASELINE_BIN),
+            'rms': (self.rms, RMS_BIN)
+        }[name]
+        first, last = min(hist), max(hist)
+        counts = np.array([hist[i] for i in xrange(first, last + 1)])
+        edges = np.arange(first, last + 2) * width * LSB
+        return edges, counts
+
+    def summary(self):
+        """Noise figures of the run, in mV but for the baseline"""
+        n = self.n_wf * self.nsamples
+        mean = self.total / n
+        baseline_mean = self.mean_sum / self.n_wf
+        baseline_var = self.mean_sq / self.n_wf - baseline_mean**2
+        df = self.freq[1] - self.freq[0]
+        return pd.Series([
+            self.n_wf, self.nsamples, mean,
+            np.sqrt(max(self.total_sq / n - mean**2, 0.)) * LSB,
+            self.rms_sum / self.n_wf * LSB,
+            np.sqrt(max(baseline_var, 0.)) * LSB,
+            np.sqrt(np.sum(self.psd()) * df)
+        ], index=[
+            'n_wf', 'nsamples', 'baseline', 'rms_total', 'rms_wf',
+            'baseline_std', 'rms_psd'
+        ])
+
+
+def file_spectrum(args):
+    """Noise spectrum of one file"""
+    infile, nperseg, nwf = args
+    spectrum = None
+    for adc in iter_blocks(infile, nwf):
+        if spectrum is None:
+            spectrum = NoiseSpectrum(adc.shape[1], nperseg)
+        spectrum.add(adc)
+    if spectrum is None or spectrum.n_wf == 0:
+        raise AssertionError('No waveforms in {0}'.format(infile))
+    return spectrum
+
+
+def run(infiles, outfile, nperseg=None, nwf=None, table=None, psd=None,
+        jobs=1):
+    """Main function to compare the noise of many runs
+
+    The spectrum of each file is accumulated in a pool of jobs processes.
+    Draws the spectra, the baselines and the RMS of the waveforms of all
+    files on top of each other and returns the table of their noise
+    figures: the mean baseline in ADC counts, the RMS of all samples, the
+    mean RMS within a waveform, the spread of the baseline between
+    waveforms and the RMS from the integral of the spectrum, in mV.
+    """
+    pool = Pool(jobs) if jobs > 1 and len(infiles) > 1 else None
+    mapper = pool.map if pool else map
+    try:
+        spectra = mapper(
+            file_spectrum, [(infile, nperseg, nwf) for infile in infiles]
+        )
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    labels = [os.path.splitext(infile)[0] for infile in infiles]
+    figures = pd.DataFrame(
+        [spectrum.summary() for spectrum in spectra],
+        index=pd.Index(labels, name='file')
+    )
+    print figures.to_string()
+    if table is not None:
+        figures.to_csv(table)
+    if psd is not None:
+        pd.concat([
+            pd.Series(spectrum.psd(), index=spectrum.freq, name=label)
+            for spectrum, label in zip(spectra, labels)
+        ], axis=1).rename_axis('frequency').to_csv(psd)
+
+    fig = plt.figure(figsize=(12, 12))
+    ax_psd = fig.add_subplot(211)
+    ax_baseline = fig.add_subplot(223)
+    ax_rms = fig.add_subplot(224)
+
+    print 'plotting...'
+    for spectrum, label in zip(spectra, labels):
+        # skip DC, which the detrending removes
+        line, = ax_psd.plot(
+            spectrum.freq[1:] / 1e6, spectrum.psd()[1:], label=label
+        )
+        for ax, name in ((ax_baseline, 'baseline'), (ax_rms, 'rms')):
+            edges, counts = spectrum.histogram(name)
+            ax.step(
+                edges, np.concatenate([[counts[0]], counts]),
+                drawstyle='steps-pre', linewidth=1, color=line.get_color()
+            )
+
+    ax_psd.set_yscale('log')
+    ax_psd.set_xlabel('Frequency (MHz)')
+    ax_psd.set_ylabel(r'PSD (mV$^2$/Hz)')
+    ax_psd.legend()
+    ax_baseline.set_yscale('log')
+    ax_rms.set_yscale('log')
+    ax_baseline.set_xlabel('Waveform mean (mV)')
+    ax_baseline.set_ylabel('N')
+    ax_rms.set_xlabel('Waveform RMS (mV)')
+    ax_rms.set_ylabel('N')
+    for ax in (ax_psd, ax_baseline, ax_rms):
+        # keep the limits of the data when drawing the grid
+        ax.set_xlim(ax.get_xlim())
+        ax.set_ylim(ax.get_ylim())
+        for ymaj in ax.yaxis.get_majorticklocs():
+            ax.axhline(y=ymaj, ls=':', color='gray', alpha=0.7, linewidth=1)
+        for xmaj in ax.xaxis.get_majorticklocs():
+            ax.axvline(x=xmaj, ls=':', color='gray', alpha=0.7, linewidth=1)
+
+    fig.savefig(outfile, bbox_inches='tight', dpi=150)
+    return figures
+
+
+def main():
+    args = parse_args()
+    run(
+        infiles = args.infiles,
+        outfile = args.outfile,
+        nperseg = args.nperseg,
+        nwf = args.nwf,
+        table = args.table,
+        psd = args.psd,
+        jobs = args.jobs
+    )
+
+    print '=========='
+    print 'DONE'
+    print '=========='
+
+
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python2
 """
-Plot charge histogram from pandas DataFrame object
+Plot charge histogram from level1 files
 """
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import matplotlib as mpl
@@ -8,12 +8,16 @@ from matplotlib import pyplot as plt
 from matplotlib.offsetbox import AnchoredText
 import numpy as np
 import pandas as pd
-from scipy.optimize import curve_fit
+
+import fit as fit_engine
 mpl.rcParams['mathtext.fontset'] = 'custom'
 mpl.rcParams['mathtext.rm'] = 'Bitstream Vera Sans'
 mpl.rcParams['mathtext.it'] = 'Bitstream Vera Sans:italic'
 mpl.rcParams['mathtext.bf'] = 'Bitstream Vera Sans:bold'
 
+# Number of waveforms to read at a time
+CHUNKSIZE = 100000
+
 
 def parse_args():
     """Get command line arguments"""
@@ -21,8 +25,10 @@ def parse_args():
         description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        '-i', '--infile', type=str, metavar='FILE', required=True,
-        help='''Path to data object'''
+        '-i', '--infiles', type=str, nargs='+', metavar='FILE',
+        required=True,
+        help='''Paths to level1 files, whose charges are histogrammed
+        together'''
     )
     parser.add_argument(
         '-o', '--outfile', type=str, default='./images/test.png',
@@ -33,57 +39,112 @@ def parse_args():
         '-b', '--bins', type=int, default='100', metavar='INT', required=False,
         help='''Number of bins'''
     )
+    parser.add_argument(
+        '-w', '--where', type=str, default=None, metavar='QUERY',
+        required=False,
+        help='''Select the waveforms to histogram by timestamp and charge,
+        e.g. "charge > 5 & timestamp < 1e12"'''
+    )
+    parser.add_argument(
+        '-r', '--range', type=float, nargs=2, default=None, metavar='FLOAT',
+        required=False,
+        help='''Range of the histogram in nVs, by default from the smallest
+        to the largest charge'''
+    )
+    parser.add_argument(
+        '-m', '--model', type=str, default='gauss', choices=fit_engine.MODELS,
+        required=False,
+        help='''Model to fit, a single gaussian or the pedestal plus n-PE
+        peaks'''
+    )
+    parser.add_argument(
+        '--fit-method', type=str, default='lsq', choices=fit_engine.METHODS,
+        required=False,
+        help='''Least squares or binned maximum likelihood fit'''
+    )
     args = parser.parse_args()
     return args
 
 
-def run(infile, outfile, bins):
+def iter_charges(infiles, where=None, chunksize=CHUNKSIZE):
+    """Stream the charge of every waveform of level1 files
+
+    Only the charge column is read, chunksize waveforms at a time.
+    """
+    for infile in infiles:
+        store = pd.HDFStore(infile, mode='r')
+        try:
+            if store.get_storer('wf').is_table:
+                chunks = store.select(
+                    'wf', where=where, columns=['charge'], iterator=True,
+                    chunksize=chunksize
+                )
+                for chunk in chunks:
+                    yield chunk['charge'].values
+            elif where is None:
+                # level1 files written before the table format
+                yield store['wf']['charge'].values
+            else:
+                raise AssertionError(
+                    'Queries need a level1 file in table format'
+                )
+        finally:
+            store.close()
+
+
+def charge_histogram(infiles, bins, where=None, charge_range=None):
+    """Histogram of the charges of level1 files, accumulated chunk by chunk
+
+    Without a charge_range the charges are read twice, first to find their
+    range. Returns the histogram and the bin edges.
+    """
+    if charge_range is None:
+        low, high = np.inf, -np.inf
+        for charges in iter_charges(infiles, where):
+            if len(charges):
+                low = min(low, np.min(charges))
+                high = max(high, np.max(charges))
+        if low > high:
+            raise AssertionError('No waveforms selected')
+        charge_range = (low, high)
+    binning = np.linspace(charge_range[0], charge_range[1], bins+1)
+    hist = np.zeros(bins, dtype=int)
+    for charges in iter_charges(infiles, where):
+        hist += np.histogram(charges, binning)[0]
+    return hist, binning
+
+
+def run(infiles, outfile, bins, where=None, charge_range=None, model='gauss',
+        fit_method='lsq'):
     """Main function to do plotting"""
-
-    store = pd.HDFStore(infile)
-    df = store['df']
-    store.close()
+    if isinstance(infiles, basestring):
+        infiles = [infiles]
+    hist, binning = charge_histogram(infiles, bins, where, charge_range)
 
     fig = plt.figure(figsize=(12, 8))
     ax = fig.add_subplot(111)
 
     print 'plotting...'
-    charges = df['charge'].unique()
-    print charges
-    assert 0
-    binning = np.linspace(np.min(charges), np.max(charges), bins+1)
-
-    ax.set_xlim(np.min(charges), np.max(charges))
+    ax.set_xlim(binning[0], binning[-1])
     # ax.set_ylim(0, 1000)
 
-    hist, _ = np.histogram(charges, binning)
     hist_0 = np.concatenate([[hist[0]], hist])
 
-    # cut away empty waveforms
-    cut_at = 0
-    hist_cut = hist[cut_at:]
-    binning_cut = binning[cut_at:]
-    bin_centres = (binning_cut[:-1] + binning_cut[1:])/2.
-
-    def gauss(x, *p):
-        A, mu, sigma = p
-        return A*np.exp(-(x-mu)**2/(2.*sigma**2))
-
-    # initial guess
-    p0 = [1., 0., 1.]
-    print hist_cut
-    coeff, var_matrix = curve_fit(gauss, bin_centres, hist_cut, p0=p0)
-    hist_fit = gauss(bin_centres, *coeff)
-    pe = (coeff[1] / coeff[2])**2
-
-    # internal impedence of DDC2 is 150 ohms
-    gain = (coeff[1] * 1e-9) / (pe * 150. * 1.6e-19)
+    fit = fit_engine.fit_spectrum(hist, binning, model, fit_method)
+    print fit.to_string()
+    if not fit['success']:
+        print 'Fit of the charge spectrum failed, plotting the histogram only'
 
     ax.step(
         binning, hist_0, alpha=1, drawstyle='steps-pre', linewidth=1,
         linestyle='-', color='r'
     )
-    ax.plot(bin_centres, hist_fit, label='Fitted with gaussian')
+    if fit['success']:
+        x = np.linspace(binning[0], binning[-1], 10 * bins + 1)
+        hist_fit = fit_engine.evaluate(fit, x, binning, model)
+        ax.plot(x, hist_fit, label='Fitted with {0}'.format(
+            'gaussian' if model == 'gauss' else 'pedestal + n-PE peaks'
+        ))
 
     ax.set_xlabel('Charge (nVs)')
     ax.set_ylabel('N')
@@ -93,15 +154,25 @@ def run(infile, outfile, bins):
     for xmaj in ax.xaxis.get_majorticklocs():
         ax.axvline(x=xmaj, ls=':', color='gray', alpha=0.7, linewidth=1)
 
-    ax.legend()
-    at = AnchoredText(r'$A = {0:.3f}$'.format(coeff[0]) + '\n' +
-                      r'$\mu = {0:.3f}$'.format(coeff[1]) + '\n' +
-                      r'$\sigma = {0:.3f}$'.format(coeff[2]) + '\n' +
-                      r'$(\frac{\mu}{\sigma})^2 = PE = ' + r'{0:.1f}$'.format(pe) + '\n' +
-                      r'gain = {0:.2e}'.format(gain),
-                      prop=dict(size=12), frameon=True, loc=5)
-    at.patch.set_boxstyle("round,pad=0.3,rounding_size=0.2")
-    ax.add_artist(at)
+    if fit['success']:
+        ax.legend()
+        if model == 'gauss':
+            text = r'$A = {0:.3f}$'.format(fit['A']) + '\n' + \
+                r'$\mu = {0:.3f}$'.format(fit['mu']) + '\n' + \
+                r'$\sigma = {0:.3f}$'.format(fit['sigma']) + '\n' + \
+                r'$(\frac{\mu}{\sigma})^2 = PE = ' + \
+                r'{0:.1f}$'.format(fit['pe'])
+        else:
+            text = r'$q_0 = {0:.3f}$'.format(fit['q0']) + '\n' + \
+                r'$q_1 = {0:.3f}$'.format(fit['q1']) + '\n' + \
+                r'$\sigma_1 = {0:.3f}$'.format(fit['s1']) + '\n' + \
+                r'$\lambda = PE = {0:.2f}$'.format(fit['pe'])
+        at = AnchoredText(
+            text + '\n' + r'gain = {0:.2e}'.format(fit['gain']),
+            prop=dict(size=12), frameon=True, loc=5
+        )
+        at.patch.set_boxstyle("round,pad=0.3,rounding_size=0.2")
+        ax.add_artist(at)
 
     fig.savefig(outfile, bbox_inches='tight', dpi=150)
 
@@ -109,9 +180,13 @@ def run(infile, outfile, bins):
 def main():
     args = parse_args()
     run(
-        infile = args.infile,
+        infiles = args.infiles,
         outfile = args.outfile,
-        bins = args.bins
+        bins = args.bins,
+        where = args.where,
+        charge_range = args.range,
+        model = args.model,
+        fit_method = args.fit_method
     )
 
     print '=========='
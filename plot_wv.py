@@ -5,6 +5,8 @@ Plot waveforms from pandas DataFrame object
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import matplotlib as mpl
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
 import numpy as np
 import pandas as pd
 import scipy.interpolate as interpolate
@@ -13,6 +15,13 @@ mpl.rcParams['mathtext.rm'] = 'Bitstream Vera Sans'
 mpl.rcParams['mathtext.it'] = 'Bitstream Vera Sans:italic'
 mpl.rcParams['mathtext.bf'] = 'Bitstream Vera Sans:bold'
 
+from l1 import CLOCK, LSB
+
+MODES = ['lines', 'density']
+
+# Number of waveforms to read at a time
+CHUNKSIZE = 10000
+
 
 def parse_args():
     """Get command line arguments"""
@@ -40,46 +49,122 @@ def parse_args():
         '--interpolate', action='store_true', default=False,
         help='''Plot the interpolated waveforms'''
     )
+    parser.add_argument(
+        '-m', '--mode', type=str, default='lines', choices=MODES,
+        required=False,
+        help='''Draw every waveform as a line, or the density of all their
+        samples in time and voltage, which scales to any number of
+        waveforms'''
+    )
+    parser.add_argument(
+        '--bins', type=int, nargs=2, default=None, metavar='INT',
+        required=False,
+        help='''Number of time and voltage bins of the density, by default
+        one time bin per sample and 200 voltage bins'''
+    )
     args = parser.parse_args()
     return args
 
 
-def run(infile, outfile, interp, nplot, ymax):
-    """Main function to do plotting"""
+def iter_adc(infile, nplot=None, chunksize=CHUNKSIZE):
+    """Stream the ADC matrix of a level1 file, chunksize waveforms at a time
+
+    Only the first nplot waveforms are read, if given.
+    """
+    store = pd.HDFStore(infile, mode='r')
+    try:
+        if store.get_storer('adc').is_table:
+            chunks = store.select(
+                'adc', stop=nplot, iterator=True, chunksize=chunksize
+            )
+            for chunk in chunks:
+                yield chunk.values
+        else:
+            # level1 files written before the table format
+            yield store['adc'].values[:nplot]
+    finally:
+        store.close()
 
-    store = pd.HDFStore(infile)
-    df = store['df']
-    store.close()
 
+def interpolation_matrix(isamp, x):
+    """Matrix taking waveforms sampled at isamp to their spline at x
+
+    The interpolating cubic spline of interpolate.splrep is linear in the
+    samples, so splev of every waveform at once is voltage.dot(matrix.T).
+    """
+    matrix = np.empty((len(x), len(isamp)))
+    for i, column in enumerate(np.eye(len(isamp))):
+        matrix[:, i] = interpolate.splev(
+            x, interpolate.splrep(isamp, column, s=0)
+        )
+    return matrix
+
+
+def run(infile, outfile, interp, nplot, ymax, mode='lines', bins=None):
+    """Main function to do plotting
+
+    In lines mode the waveforms are drawn as a single LineCollection. In
+    density mode the samples of all waveforms are histogrammed in time and
+    voltage chunk by chunk, so only the histogram is kept in memory.
+    """
     fig = plt.figure(figsize=(12, 8))
     ax = fig.add_subplot(111)
 
-    ax.set_xlim(0, np.max(df['isamp']))
-    ax.set_ylim(-ymax/10, ymax)
-
     print 'plotting...'
-    if not interp:
-        if nplot is None:
-            df.plot(x='isamp', y='voltage', ax=ax)
+    if mode == 'lines':
+        voltage = np.concatenate(list(iter_adc(infile, nplot))) * LSB
+        isamp = CLOCK * np.arange(voltage.shape[1])
+        if not interp:
+            segments = np.empty(voltage.shape + (2,))
+            segments[:, :, 0] = isamp
+            segments[:, :, 1] = voltage
+            colors = mpl.rcParams['axes.prop_cycle'].by_key()['color']
+            ax.add_collection(LineCollection(
+                segments, colors=colors,
+                linewidths=mpl.rcParams['lines.linewidth']
+            ))
         else:
-            wv_idx = df['index'].unique()
-            for i, idx in enumerate(wv_idx):
-                if i == nplot:
-                    break
-                wv_df = df[df['index'] == idx]
-                wv_df.plot(x='isamp', y='voltage', ax=ax)
+            x = np.linspace(0, isamp[-1], 200)
+            y = voltage.dot(interpolation_matrix(isamp, x).T)
+            segments = np.empty(y.shape + (2,))
+            segments[:, :, 0] = x
+            segments[:, :, 1] = y
+            ax.scatter(
+                segments[:, :, 0].ravel(), segments[:, :, 1].ravel(),
+                marker='o', c='blue'
+            )
+            ax.add_collection(LineCollection(
+                segments, linestyles='-', linewidths=1, colors='blue'
+            ))
+    elif mode == 'density':
+        hist = None
+        for adc in iter_adc(infile, nplot):
+            voltage = adc * LSB
+            if hist is None:
+                isamp = CLOCK * np.arange(voltage.shape[1])
+                if bins is None:
+                    bins = (len(isamp), 200)
+                xedges = np.linspace(
+                    -CLOCK / 2., isamp[-1] + CLOCK / 2., bins[0] + 1
+                )
+                yedges = np.linspace(-ymax/10, ymax, bins[1] + 1)
+                hist = np.zeros(bins, dtype=int)
+            hist += np.histogram2d(
+                np.broadcast_to(isamp, voltage.shape).ravel(),
+                voltage.ravel(), (xedges, yedges)
+            )[0].astype(int)
+        if hist is None:
+            raise AssertionError('No waveforms in {0}'.format(infile))
+        mesh = ax.pcolormesh(
+            xedges, yedges, np.ma.masked_equal(hist.T, 0), norm=LogNorm(),
+            cmap='viridis'
+        )
+        fig.colorbar(mesh, ax=ax, label='N')
     else:
-        wv_idx = df['index'].unique()
-        for i, idx in enumerate(wv_idx):
-            if nplot is not None:
-                if i == nplot:
-                    break
-            wv_df = df[df['index'] == idx]
-            spl = interpolate.splrep(wv_df['isamp'], wv_df['voltage'], s=0)
-            x = np.linspace(0, np.max(wv_df['isamp']), 200)
-            y = interpolate.splev(x, spl)
-            ax.scatter(x, y, marker='o', c='blue')
-            ax.plot(x, y, linestyle='-', linewidth=1, c='blue')
+        raise ValueError('Unknown mode {0}'.format(mode))
+
+    ax.set_xlim(0, isamp[-1])
+    ax.set_ylim(-ymax/10, ymax)
 
     ax.set_xlabel('Time (ns)')
     ax.set_ylabel('Voltage (mV)')
@@ -103,7 +188,9 @@ def main():
         outfile = args.outfile,
         interp = args.interpolate,
         nplot = args.nplot,
-        ymax = args.ymax
+        ymax = args.ymax,
+        mode = args.mode,
+        bins = args.bins
     )
 
     print '=========='
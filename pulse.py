@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+"""
+Batch pulse feature extraction of DDC2 waveforms.
+"""
+import numpy as np
+
+
+FEATURES = [
+    'amplitude', 'peak_sample', 'rise_time', 'fwhm', 'time_over_threshold',
+    'cfd_time'
+]
+
+
+def crossings(pulses, peak, level):
+    """Where each pulse crosses its level before and after its peak
+
+    The crossings are in samples, linearly interpolated between the last
+    sample below level and the next one on the leading edge, and between
+    the last one above and the first one below on the trailing edge. They
+    are NaN where a pulse does not cross its level on that side of the peak,
+    or where the level is above the peak.
+    """
+    n, nsamples = pulses.shape
+    rows = np.arange(n)
+    isamp = np.arange(nsamples)
+    level = np.asarray(level, dtype=float)
+    below = pulses < level[:, None]
+    leading_edge = below & (isamp < peak[:, None])
+    trailing_edge = below & (isamp > peak[:, None])
+    # last sample below level before the peak, first one after it
+    before = nsamples - 1 - leading_edge[:, ::-1].argmax(axis=1)
+    after = trailing_edge.argmax(axis=1)
+    valid = level <= pulses[rows, peak]
+
+    leading = np.full(n, np.nan)
+    ok = valid & leading_edge.any(axis=1)
+    i, r = before[ok], rows[ok]
+    leading[ok] = i + (level[ok] - pulses[r, i]) / (
+        pulses[r, i+1] - pulses[r, i]
+    )
+    trailing = np.full(n, np.nan)
+    ok = valid & trailing_edge.any(axis=1)
+    j, r = after[ok], rows[ok]
+    trailing[ok] = j - 1 + (pulses[r, j-1] - level[ok]) / (
+        pulses[r, j-1] - pulses[r, j]
+    )
+    return leading, trailing
+
+
+def features(pulses, step=1., cfd_fraction=0.2, threshold=0.):
+    """Pulse features of every row of a (n_waveforms, nsamples) array at once
+
+    The pulses are positive and around zero. Returns a dict with the
+    amplitude, in the units of pulses, the sample of the peak, and in units
+    of step the 10-90% rise time, the full width at half maximum, the time
+    over threshold and the constant fraction time, where the leading edge
+    crosses cfd_fraction of the amplitude, from the first sample. Pulses
+    which stay above threshold until the end have no time over threshold,
+    and those which never reach it have zero. Waveforms whose maximum is at
+    or below zero have no rise time, FWHM or constant fraction time.
+    """
+    pulses = np.atleast_2d(pulses).astype(float)
+    n = len(pulses)
+    peak = pulses.argmax(axis=1)
+    amplitude = pulses[np.arange(n), peak]
+    rise_start, _ = crossings(pulses, peak, 0.1 * amplitude)
+    rise_stop, _ = crossings(pulses, peak, 0.9 * amplitude)
+    half_leading, half_trailing = crossings(pulses, peak, 0.5 * amplitude)
+    cfd, _ = crossings(pulses, peak, cfd_fraction * amplitude)
+    tot_leading, tot_trailing = crossings(pulses, peak, np.full(n, threshold))
+    tot = np.where(amplitude >= threshold, tot_trailing - tot_leading, 0.)
+    # the levels of waveforms without a pulse are at or above their peak
+    no_pulse = amplitude <= 0
+    rise_time = np.where(no_pulse, np.nan, rise_stop - rise_start)
+    fwhm = np.where(no_pulse, np.nan, half_trailing - half_leading)
+    cfd = np.where(no_pulse, np.nan, cfd)
+    return {
+        'amplitude': amplitude,
+        'peak_sample': peak,
+        'rise_time': rise_time * step,
+        'fwhm': fwhm * step,
+        'time_over_threshold': tot * step,
+        'cfd_time': cfd * step
+    }
@@ -4,16 +4,26 @@ Records the raw input from the DDC2 through the Quartus 2 nios2eds terminal and
 saves the data to disk.
 """
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from copy import deepcopy
 from datetime import datetime
 import gzip
-from multiprocessing import Process
+import json
 import numpy as np
 import os, sys
+from Queue import Queue
 import signal
 import subprocess
+from threading import Thread
 from timeit import default_timer as timer
 
+from l1 import (
+    L0_HEADER_FILE, L0_META_SUFFIX, L0Parser, SEPARATOR, decode_samples,
+    write_binary
+)
+from metrics import Metrics
+from monitor import ChargeMonitor
+from replay import replay_setup
+from zero_suppression import ZeroSuppression
+
 
 COMMAND = 'nios2-download -g {0} && {1} | nios2-terminal'
 
@@ -24,8 +34,9 @@ def parse_args():
         description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        '-i', '--settings', type=str, metavar='FILE', required=True,
-        help='''DDC2 settings file'''
+        '-i', '--settings', type=str, default=None, metavar='FILE',
+        required=False,
+        help='''DDC2 settings file, required unless replaying'''
     )
     parser.add_argument(
         '-d', '--ddc_dfile', type=str, metavar='FILE',
@@ -44,11 +55,83 @@ def parse_args():
         '--chunk', type=int, default=1e5, metavar='INT', required=False,
         help='''Number of lines to save before splitting into a new file'''
     )
+    parser.add_argument(
+        '--writers', type=int, default=2, metavar='INT', required=False,
+        help='''Number of threads compressing and saving the chunks'''
+    )
+    parser.add_argument(
+        '--format', type=str, default='text', dest='l0_format',
+        choices=['text', 'binary', 'both'], required=False,
+        help='''Save the level0 data as gzipped text, in the memory mappable
+        binary format or both'''
+    )
+    parser.add_argument(
+        '--replay', type=str, default=None, metavar='PATH', required=False,
+        help='''Replay recorded level0 data from a folder or file instead of
+        running the DDC2'''
+    )
+    parser.add_argument(
+        '--replay-rate', type=float, default=0., metavar='FLOAT',
+        required=False,
+        help='''Number of lines per second to replay, 0 for as fast as
+        possible'''
+    )
+    parser.add_argument(
+        '--monitor', action='store_true', default=False,
+        help='''Monitor the charge spectrum and rates during the run'''
+    )
+    parser.add_argument(
+        '--monitor-bins', type=int, default=100, metavar='INT',
+        required=False, help='''Number of bins of the monitored charge'''
+    )
+    parser.add_argument(
+        '--monitor-range', type=float, nargs=2, default=[0., 100.],
+        metavar='FLOAT', required=False,
+        help='''Range of the monitored charge in nVs'''
+    )
+    parser.add_argument(
+        '--monitor-interval', type=float, default=10., metavar='FLOAT',
+        required=False,
+        help='''Seconds between refits of the monitored charge'''
+    )
+    parser.add_argument(
+        '--no-invert', action='store_true', default=False,
+        help='''Do not invert the waveforms after subtracting the baseline in
+        the monitor and the zero suppression, as l1 --no-invert does'''
+    )
+    parser.add_argument(
+        '--zs-threshold', type=float, default=None, metavar='FLOAT',
+        required=False,
+        help='''Only save waveforms whose baseline subtracted amplitude
+        reaches this many mV'''
+    )
+    parser.add_argument(
+        '--zs-min-charge', type=float, default=None, metavar='FLOAT',
+        required=False,
+        help='''Only save waveforms with at least this charge in nVs'''
+    )
+    parser.add_argument(
+        '--zs-prescale', type=int, default=0, metavar='INT', required=False,
+        help='''Save one in every this many waveforms rejected by
+        --zs-threshold and --zs-min-charge anyway, 0 for none'''
+    )
+    parser.add_argument(
+        '--metrics', type=str, default=None, metavar='FILE', required=False,
+        help='''Save a JSON summary of the acquisition metrics to file'''
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=10., metavar='FLOAT',
+        required=False,
+        help='''Seconds between reports of the acquisition rates to stderr, 0
+        to disable'''
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true', default=False,
         help='''Verbose'''
     )
     args = parser.parse_args()
+    if args.settings is None and args.replay is None:
+        parser.error('-i/--settings is required unless replaying')
     return args
 
 
@@ -68,12 +151,83 @@ def run_setup(command):
     return p3
 
 
-def run(settings, ddc_dfile, time_lim, outdir, chunk, verbose):
-    """Main function to run FPGA and DDC2 chain and collect the data"""
+def save_chunk(outdir, ichunk, stream, waveforms, l0_format, meta=None):
+    """Save a chunk of level0 data to disk
+
+    meta, e.g. what zero suppression rejected from the chunk, is saved next
+    to it as json.
+    """
+    try:
+        os.makedirs(outdir, mode=0755)
+    except OSError as err:
+        pass
+    of = outdir+'/level0_{0:06d}'.format(ichunk)
+    if l0_format != 'binary':
+        with gzip.GzipFile(of+'.txt.gz', 'wb') as outfile:
+            outfile.write(''.join(stream))
+    if l0_format != 'text':
+        write_binary(of+'.bin', waveforms)
+    if meta is not None:
+        with open(of+L0_META_SUFFIX, 'w') as outfile:
+            json.dump(meta, outfile, indent=2, sort_keys=True)
+
+
+def chunk_writer(queue):
+    """Save the chunks put on the queue until told to stop with None"""
+    while True:
+        item = queue.get()
+        try:
+            if item is None:
+                return
+            save_chunk(*item)
+        except Exception as err:
+            print 'Error saving chunk {0}: {1}'.format(item[1], err)
+        finally:
+            queue.task_done()
+
+
+def start_writers(n_writers):
+    """Start a fixed pool of threads saving the chunks put on a queue
+
+    The queue is bounded so that, if the writers fall behind, the reader
+    blocks on put instead of piling up chunks in memory. gzip and numpy
+    release the GIL while compressing and writing.
+    """
+    queue = Queue(maxsize=2*n_writers)
+    threads = []
+    for _ in range(n_writers):
+        thread = Thread(target=chunk_writer, args=(queue,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return queue, threads
+
+
+def stop_writers(queue, threads):
+    """Wait for the writers to save the remaining chunks and stop them"""
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def run(settings, ddc_dfile, time_lim, outdir, chunk, verbose,
+        l0_format='text', n_writers=2, metrics=None, replay=None,
+        replay_rate=0., monitor=None, zero_suppression=None):
+    """Main function to run FPGA and DDC2 chain and collect the data
+
+    With zero_suppression, the lines of each waveform are held until it is
+    complete and only saved if it is kept.
+    """
     print '=========='
     print 'Running for {0}s'.format(time_lim)
 
-    process = run_setup(COMMAND.format(ddc_dfile, settings))
+    if replay is None:
+        process = run_setup(COMMAND.format(ddc_dfile, settings))
+        flush_time = 2
+    else:
+        process = replay_setup(replay, replay_rate)
+        flush_time = 0
 
     def signal_handler(sig, frame):
         print 'Caught signal, cleaning up\n'
@@ -81,13 +235,21 @@ def run(settings, ddc_dfile, time_lim, outdir, chunk, verbose):
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
 
-    stream = ''
+    if metrics is None:
+        metrics = Metrics(interval=0)
+    queue, writers = start_writers(n_writers)
+    stream = []
+    parser = L0Parser()
+    waveforms = []
+    # lines of the waveform being recorded, with zero suppression
+    pending = []
+    meta = None
     baseline = 0
     skip_intro = True
     skip_initial_wv = True
     idx = 0
     try:
-        for line in iter(process.stdout.readline, b''):
+        for line in metrics.lines(process.stdout):
             if skip_intro:
                 try:
                     int(line.split(',')[0])
@@ -96,8 +258,14 @@ def run(settings, ddc_dfile, time_lim, outdir, chunk, verbose):
                     if 'INVALID' in line:
                         raise AssertionError('Reset the DDC2 and run again')
                     if 'TAP_GET_BASELINE' in line:
-                        stream += 'BASELINE = ' + line.split(' ')[-1][1:-2]
-                        stream += '\n'
+                        stream.append(
+                            'BASELINE = ' + line.split(' ')[-1][1:-2] + '\n'
+                        )
+                        baseline = int(line.split(' ')[-1][1:-2])
+                        if monitor is not None:
+                            monitor.baseline = baseline
+                        if zero_suppression is not None:
+                            zero_suppression.baseline = baseline
                     idx += 1
                     continue
                 else:
@@ -110,16 +278,28 @@ def run(settings, ddc_dfile, time_lim, outdir, chunk, verbose):
             if skip_initial_wv:
                 time = timer()
                 # Wait before recording any data to flush previous buffer
-                if time - start_t < 2 or '---------------------------' in line:
+                if (time - start_t < flush_time or
+                        '---------------------------' in line):
                     continue
                 else:
                     initial_timestamp = datetime.now()
-                    stream += 'INITIAL TIMESTAMP = {0}'.format(datetime.now())
-                    stream += '\n\n'
+                    stream.append(
+                        'INITIAL TIMESTAMP = {0}\n\n'.format(datetime.now())
+                    )
+                    if l0_format != 'text':
+                        try:
+                            os.makedirs(outdir, mode=0755)
+                        except OSError as err:
+                            pass
+                        with open(outdir+'/'+L0_HEADER_FILE, 'w') as f:
+                            f.write(''.join(stream))
+                    if l0_format == 'binary':
+                        stream = []
                     start_t = timer()
                     skip_initial_wv = False
 
             time = timer()
+            metrics.report(time)
             if verbose:
                 print line,
             if time - start_t > time_lim:
@@ -128,53 +308,134 @@ def run(settings, ddc_dfile, time_lim, outdir, chunk, verbose):
             # if 'timestamp' in line:
             #     stream += 'datetime timestamp = {0}\n'.format(datetime.now())
 
-            stream += line
+            separator = line.startswith(SEPARATOR)
+            if separator:
+                metrics.count('waveforms')
+            keep = True
+            if (l0_format != 'text' or monitor is not None or
+                    zero_suppression is not None):
+                wf = parser.feed(line)
+                if wf is not None:
+                    if len(wf.samples) != wf.nsamples:
+                        metrics.count('incomplete')
+                    elif monitor is not None or zero_suppression is not None:
+                        rows, _ = decode_samples([wf])
+                        if monitor is not None:
+                            start_monitor = timer()
+                            monitor.add(rows[:,1], wf.fpga_ts)
+                            monitor.report(time)
+                            metrics.time('monitor', timer() - start_monitor)
+                        if zero_suppression is not None:
+                            start_zs = timer()
+                            keep = zero_suppression.keep(rows[:,1])
+                            metrics.time(
+                                'zero_suppression', timer() - start_zs
+                            )
+                            if not keep:
+                                metrics.count('rejected')
+                    if l0_format != 'text' and keep:
+                        waveforms.append(wf)
+            if l0_format != 'binary':
+                if zero_suppression is None:
+                    stream.append(line)
+                elif separator:
+                    # the separator completes the waveform before it
+                    if keep:
+                        stream.extend(pending)
+                    pending = [line]
+                else:
+                    pending.append(line)
+            metrics.time('parse', timer() - time)
 
             if idx % chunk == 0:
-                s_copy = deepcopy(stream)
-                def save_to_disk():
-                    try:
-                        os.makedirs(outdir, mode=0755)
-                    except OSError as err:
-                        pass
-                    of = outdir+'/level0_{0:06d}.txt.gz'.format(int(idx/chunk))
-                    with gzip.GzipFile(of, 'wb') as outfile:
-                        outfile.write(s_copy)
-                p = Process(target = save_to_disk)
-                p.start()
-                stream = ''
+                if zero_suppression is not None:
+                    meta = zero_suppression.chunk_summary()
+                start_put = timer()
+                queue.put((
+                    outdir, int(idx/chunk), stream, waveforms, l0_format, meta
+                ))
+                metrics.time('queue_wait', timer() - start_put)
+                metrics.gauge('queue_depth', queue.qsize())
+                stream = []
+                waveforms = []
             idx += 1
     except:
         print 'Error, cleaning up\n'
         os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+        stop_writers(queue, writers)
+        if zero_suppression is not None:
+            meta = zero_suppression.chunk_summary()
+        if l0_format != 'text':
+            save_chunk(
+                outdir, int((idx-1)/chunk)+1, [], waveforms, 'binary', meta
+            )
         print 'Dumping data to dump_{0:06d}.txt'.format(int(idx/chunk))
         of = './dump_{0:06d}.txt'.format(int(idx/chunk))
         with open(of, 'wb') as outfile:
-            outfile.write(stream)
+            outfile.write(''.join(stream + pending))
         raise
     os.killpg(os.getpgid(process.pid), signal.SIGTERM)
 
-    try:
-        os.makedirs(outdir, mode=0755)
-    except OSError as err:
-        pass
-    outfile = outdir+'/level0_{0:06d}.txt.gz'.format(int(idx/chunk))
-
-    with gzip.GzipFile(outfile, 'wb') as outfile:
-        outfile.write(stream)
-    stream = ''
+    wf = parser.flush()
+    keep = True
+    if wf is not None:
+        if len(wf.samples) == wf.nsamples and (
+                monitor is not None or zero_suppression is not None):
+            rows, _ = decode_samples([wf])
+            if monitor is not None:
+                monitor.add(rows[:,1], wf.fpga_ts)
+            if zero_suppression is not None:
+                keep = zero_suppression.keep(rows[:,1])
+                if not keep:
+                    metrics.count('rejected')
+        if keep:
+            waveforms.append(wf)
+    if keep:
+        stream.extend(pending)
+    if zero_suppression is not None:
+        meta = zero_suppression.chunk_summary()
+    # lines after the last chunk boundary go to the next chunk
+    queue.put((
+        outdir, int((idx-1)/chunk)+1, stream, waveforms, l0_format, meta
+    ))
+    stop_writers(queue, writers)
 
 
 def main():
     args = parse_args()
+    metrics = Metrics(args.metrics_interval)
+    monitor = None
+    if args.monitor:
+        monitor = ChargeMonitor(
+            bins=args.monitor_bins, charge_range=args.monitor_range,
+            interval=args.monitor_interval, invert=not args.no_invert
+        )
+    zero_suppression = None
+    if args.zs_threshold is not None or args.zs_min_charge is not None:
+        zero_suppression = ZeroSuppression(
+            threshold=args.zs_threshold, min_charge=args.zs_min_charge,
+            prescale=args.zs_prescale, invert=not args.no_invert
+        )
     run(
         settings = args.settings,
         ddc_dfile = args.ddc_dfile,
         time_lim = args.time,
         outdir = args.outdir,
         chunk = args.chunk,
-        verbose = args.verbose
+        verbose = args.verbose,
+        l0_format = args.l0_format,
+        n_writers = args.writers,
+        metrics = metrics,
+        replay = args.replay,
+        replay_rate = args.replay_rate,
+        monitor = monitor,
+        zero_suppression = zero_suppression
     )
+    metrics.summary(args.metrics)
+    if zero_suppression is not None:
+        print 'Zero suppression: {0}'.format(zero_suppression.summary())
+    if monitor is not None:
+        monitor.report(force=True)
 
     print '=========='
     print 'DONE'
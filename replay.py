@@ -0,0 +1,102 @@
+#!/usr/bin/env python2
+"""
+Replays recorded level0 data as if it came from the DDC2 through
+nios2-terminal, so the acquisition can be run without the hardware.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import os, sys
+import subprocess
+import time
+
+from l1 import l0_files, l0_lines, read_header
+
+
+INTRO = [
+    'nios2-terminal: connected to hardware target using JTAG UART\n',
+    'nios2-terminal: "Ctrl-C" to exit (replay)\n',
+    'DDC2 replay\n'
+]
+
+
+def parse_args():
+    """Get command line arguments"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-i', '--input', type=str, metavar='PATH', required=True,
+        help='''Folder containing level0 data, or a single level0 or dump
+        file'''
+    )
+    parser.add_argument(
+        '-r', '--rate', type=float, default=0., metavar='FLOAT',
+        required=False,
+        help='''Number of lines per second to replay, 0 for as fast as
+        possible'''
+    )
+    args = parser.parse_args()
+    return args
+
+
+def replay_setup(path, rate):
+    """Start replaying recorded data in place of the DDC2 chain"""
+    cmd = [
+        sys.executable, os.path.join(os.path.dirname(__file__), 'replay.py'),
+        '-i', path, '-r', str(rate)
+    ]
+    print 'Executing command:', ' '.join(cmd)
+    print '=========='
+    p = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, bufsize=1, preexec_fn=os.setsid
+    )
+    return p
+
+
+def run(path, rate, out=sys.stdout):
+    """Main function to replay the data"""
+    if os.path.isdir(path):
+        filenames = l0_files(path)
+    else:
+        filenames = [path]
+    if filenames[0].endswith('.bin'):
+        raise AssertionError('Only text level0 data can be replayed')
+    baseline, _ = read_header(filenames[0])
+
+    # the acquisition expects at least 10 lines of set up output, including
+    # the baseline, and discards the sample line which ends them
+    intro = INTRO + ['\n'] * 10
+    intro.append('TAP_GET_BASELINE ({0})\n'.format(baseline))
+    intro.append('    0,     0,     0,   0,   0, \n')
+    out.writelines(intro)
+    out.flush()
+
+    start = time.time()
+    for idx, line in enumerate(l0_lines(filenames)):
+        if line.startswith('BASELINE') or line.startswith('INITIAL TIMESTAMP'):
+            continue
+        out.write(line)
+        if rate > 0 and idx % 100 == 0:
+            out.flush()
+            delay = start + idx / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    out.flush()
+
+
+def main():
+    args = parse_args()
+    try:
+        run(
+            path = args.input,
+            rate = args.rate
+        )
+    except IOError:
+        # the reading end stopped the acquisition
+        pass
+
+
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,9 @@
 """
 Runs DDC2 through nios2-terminal
 """
+from multiprocessing import Process, Queue
 import os, sys
+from Queue import Empty, Full
 import signal
 import subprocess
 import numpy as np
@@ -10,6 +12,10 @@ from timeit import default_timer as timer
 import argparse
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+from metrics import Metrics
+from monitor import ChargeMonitor
+from replay import replay_setup
+
 
 COMMAND = 'nios2-download -g {0} && {1} | nios2-terminal'
 
@@ -37,7 +43,8 @@ def parse_args():
     )
     parser.add_argument(
         '-i', '--infile', type=is_valid_file, action=FullPaths,
-        metavar='FILE', required=True, help='''Settings file'''
+        default=None, metavar='FILE', required=False,
+        help='''Settings file, required unless replaying'''
     )
     parser.add_argument(
         '-d', '--ddc_file', type=is_valid_file, action=FullPaths,
@@ -57,11 +64,62 @@ def parse_args():
         '--live', action='store_true', default=False,
         help='''Live visualisation'''
     )
+    parser.add_argument(
+        '--live-fps', type=float, default=10., metavar='FLOAT',
+        required=False,
+        help='''Frame rate of the live visualisation'''
+    )
+    parser.add_argument(
+        '--replay', type=str, default=None, metavar='PATH', required=False,
+        help='''Replay recorded level0 data from a folder or file instead of
+        running the DDC2'''
+    )
+    parser.add_argument(
+        '--replay-rate', type=float, default=0., metavar='FLOAT',
+        required=False,
+        help='''Number of lines per second to replay, 0 for as fast as
+        possible'''
+    )
+    parser.add_argument(
+        '--monitor', action='store_true', default=False,
+        help='''Monitor the charge spectrum and rates during the run'''
+    )
+    parser.add_argument(
+        '--monitor-bins', type=int, default=100, metavar='INT',
+        required=False, help='''Number of bins of the monitored charge'''
+    )
+    parser.add_argument(
+        '--monitor-range', type=float, nargs=2, default=[0., 100.],
+        metavar='FLOAT', required=False,
+        help='''Range of the monitored charge in nVs'''
+    )
+    parser.add_argument(
+        '--monitor-interval', type=float, default=10., metavar='FLOAT',
+        required=False,
+        help='''Seconds between refits of the monitored charge'''
+    )
+    parser.add_argument(
+        '--no-invert', action='store_true', default=False,
+        help='''Do not invert the waveforms after subtracting the baseline in
+        the monitor, as l1 --no-invert does'''
+    )
+    parser.add_argument(
+        '--metrics', type=str, default=None, metavar='FILE', required=False,
+        help='''Save a JSON summary of the acquisition metrics to file'''
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=10., metavar='FLOAT',
+        required=False,
+        help='''Seconds between reports of the acquisition rates to stderr, 0
+        to disable'''
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true', default=False,
         help='''Verbose'''
     )
     args = parser.parse_args()
+    if args.infile is None and args.replay is None:
+        parser.error('-i/--infile is required unless replaying')
     return args
 
 
@@ -86,51 +144,173 @@ def parse(arr_str):
     return arr_str.rstrip().replace(' ', '').split(',')[:-1]
 
 
-def check_data(raw_data, nsamples, verbose):
-    """Remove the data which only partially captures a full waveform"""
-    if verbose:
-        print 'raw_data', raw_data
-        print 'raw_data.shape', raw_data.shape
+class WaveformBuffer(object):
+    """Incremental parser of nios2-terminal lines into a waveform array
+
+    Lines are fed one at a time as they are read and the samples are written
+    straight into a preallocated (n_waveforms, nsamples, 7) array, holding
+    isamp, adc, time, tot, eoe, timestamp and local time, which doubles in
+    size when full. A waveform is only committed once all of its samples
+    have arrived in order, waveforms which are cut short or start part way
+    through are dropped and counted in incomplete.
+    """
+    def __init__(self, capacity=1024, verbose=False):
+        self.capacity = capacity
+        self.verbose = verbose
+        self.data = None
+        self.n_wf = 0
+        self.nsamples = 0
+        self.timestamp = 0
+        self.local_time = 0
+        self.n_count = 0
+        self.incomplete = 0
+
+    def feed(self, line):
+        """Parse a single line"""
+        if line.count(',') == 5:
+            if self.nsamples == 0:
+                return
+            try:
+                sample = map(int, line.split(',')[:5])
+            except ValueError:
+                return
+            timing = sample[0]
+            if timing != self.n_count:
+                # n_count is -1 while skipping the rest of a dropped waveform
+                if self.n_count != -1:
+                    self.drop(timing)
+                if timing != 0:
+                    return
+            row = self.data[self.n_wf, timing]
+            row[:5] = sample
+            row[5] = self.timestamp
+            row[6] = self.local_time
+            if timing == self.nsamples - 1:
+                self.commit()
+            else:
+                self.n_count = timing + 1
+        elif 'Nsamples' in line:
+            if self.nsamples == 0:
+                self.nsamples = int(line.split()[2])
+                self.data = np.empty(
+                    (self.capacity, self.nsamples, 7), dtype=int
+                )
+        elif 'timestamp' in line:
+            self.timestamp = int(line.split()[3][:-1])
+        elif 'local time' in line:
+            self.local_time = int(line.split()[4][:-1])
+
+    def drop(self, timing):
+        """Drop the waveform in progress"""
+        if self.verbose:
+            print 'Dropping incomplete waveform, expected sample {0} and ' \
+                'got {1}'.format(self.n_count, timing)
+        self.incomplete += 1
+        self.n_count = -1
+
+    def commit(self):
+        """Keep the completed waveform, growing the array if it is full"""
+        self.n_wf += 1
+        self.n_count = 0
+        if self.n_wf == len(self.data):
+            data = np.empty(
+                (2 * len(self.data), self.nsamples, 7), dtype=int
+            )
+            data[:self.n_wf] = self.data
+            self.data = data
+
+    def result(self):
+        """The completed waveforms, counting any still in progress as
+        incomplete"""
+        if self.n_count > 0:
+            self.drop(None)
+        if self.data is None:
+            return np.empty((0, 0, 7), dtype=int)
+        return self.data[:self.n_wf]
+
+
+def live_display(queue, fps):
+    """Draw the latest waveform from queue at a fixed frame rate
+
+    Runs in its own process, so drawing never holds up the acquisition. The
+    artists are created once and updated in place. A None on the queue ends
+    the display.
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib.offsetbox import AnchoredText
+    fig = plt.figure(figsize=(12, 8))
+    ax = fig.add_subplot(111)
+    ax.set_xlabel('Time (4ns)')
+    ax.set_ylabel('Voltage (A.U.)')
+    ax.xaxis.grid(True, which='major')
+    ax.yaxis.grid(True, which='major')
+    line, = ax.plot(
+        [], [], marker='o', linestyle='--', linewidth=1, c='crimson'
+    )
+    at = AnchoredText('', prop=dict(size=14), frameon=True, loc=1)
+    at.patch.set_boxstyle("round,pad=0.,rounding_size=0.5")
+    ax.add_artist(at)
+    xmax = 1
+    ymin, ymax = (999999, 1)
+
+    while plt.fignum_exists(fig.number):
+        start = timer()
+        wf = None
+        try:
+            while True:
+                wf = queue.get_nowait()
+                if wf is None:
+                    return
+        except Empty:
+            pass
+        if wf is not None:
+            xmax = max(xmax, np.max(wf[:,0]))
+            ymin = min(ymin, np.min(wf[:,1]))
+            ymax = max(ymax, np.max(wf[:,1]))
+            line.set_data(wf[:,0], wf[:,1])
+            ax.set_xlim(0, xmax)
+            ax.set_ylim(ymin, ymax)
+            diff = np.max(wf[:,1]) - np.min(wf[:,1])
+            at.txt.set_text(
+                'min = {0}\nmax = {1}\ndiff = {2}'.format(ymin, ymax, diff)
+            )
+        plt.pause(max(1. / fps - (timer() - start), 0.001))
 
-    uc_timings, uc_run_counts = np.unique(raw_data[:,0], return_counts=True)
-    if verbose:
-        print 'uc_timings', uc_timings
-        print 'uc_run_counts', uc_run_counts
-
-    n_of_runs = set(uc_run_counts)
-    if len(n_of_runs) != 1 and len(n_of_runs) != 2:
-        raise AssertionError(
-            'Something bad happened!\nn_of_runs = {0}\nlen(n_of_runs) = '
-            '{1}'.format(n_of_runs, len(n_of_runs))
-        )
 
-    if len(n_of_runs) == 2:
-        if np.diff(list(n_of_runs))[0] != 1:
-            raise AssertionError(
-                'Something bad happened!\nn_of_runs = '
-                '{0}\nnp.diff(list(n_of_runs))[0] = '
-                '{1}'.format(n_of_runs, np.diff(list(n_of_runs))[0])
-            )
-        n_incomplete_pulse = np.sum(uc_run_counts == np.max(list(n_of_runs)))
-        if verbose:
-            print 'n_incomplete_pulse', n_incomplete_pulse
-        clean_data = raw_data[:-n_incomplete_pulse]
-    else:
-        clean_data = raw_data
+def start_live(fps):
+    """Start the live display, fed by a queue of the latest waveforms"""
+    queue = Queue(maxsize=2)
+    display = Process(target=live_display, args=(queue, fps))
+    display.daemon = True
+    display.start()
+    return queue, display
 
-    if verbose:
-        print 'clean_data', clean_data
-        print 'clean_data.shape', clean_data.shape
 
-    return clean_data
+def stop_live(queue, display):
+    """Close the live display"""
+    try:
+        queue.put(None, timeout=1)
+    except Full:
+        pass
+    display.join(1)
+    if display.is_alive():
+        display.terminate()
 
 
-def run(infile, ddc_file, time_lim, live, verbose):
+def run(infile, ddc_file, time_lim, live, verbose, metrics=None,
+        replay=None, replay_rate=0., live_fps=10., monitor=None):
     """Main function to run FPGA and DDC2 chain and collect the data"""
+    if metrics is None:
+        metrics = Metrics(interval=0)
     print '=========='
     print 'Running for {0}s'.format(time_lim)
 
-    process = run_setup(COMMAND.format(ddc_file, infile))
+    if replay is None:
+        process = run_setup(COMMAND.format(ddc_file, infile))
+        flush_time = 2
+    else:
+        process = replay_setup(replay, replay_rate)
+        flush_time = 0
 
     def signal_handler(sig, frame):
         print 'Caught signal, cleaning up\n'
@@ -138,24 +318,15 @@ def run(infile, ddc_file, time_lim, live, verbose):
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
 
-    str_data = []
+    wf_buffer = WaveformBuffer(verbose=verbose)
     skip_intro = True
     skip_initial_wv = True
     idx = 0
+    n_done = 0
+    if live:
+        live_queue, display = start_live(live_fps)
     try:
-        if live:
-            from matplotlib import pyplot as plt
-            from matplotlib.offsetbox import AnchoredText
-            plt.ion()
-            fig = plt.figure(figsize=(12, 8))
-            ax = fig.add_subplot(111)
-            ax.set_xlabel('Time (4ns)')
-            ax.set_ylabel('Voltage (A.U.)')
-            xmax = 1
-            ymin, ymax = (999999, 1)
-            live_data = []
-
-        for line in iter(process.stdout.readline, b''):
+        for line in metrics.lines(process.stdout):
             if skip_intro:
                 try:
                     int(line.split(',')[0])
@@ -163,6 +334,8 @@ def run(infile, ddc_file, time_lim, live, verbose):
                     print line,
                     if 'INVALID' in line:
                         raise AssertionError('Reset the DDC2 and run again')
+                    if 'TAP_GET_BASELINE' in line and monitor is not None:
+                        monitor.baseline = int(line.split(' ')[-1][1:-2])
                     idx += 1
                     continue
                 else:
@@ -174,123 +347,76 @@ def run(infile, ddc_file, time_lim, live, verbose):
             if skip_initial_wv:
                 time = timer()
                 # Wait before recording any data to flush previous buffer
-                if time - start_t < 2 or '---------------------------' in line:
+                if (time - start_t < flush_time or
+                        '---------------------------' in line):
                     continue
                 else:
                     start_t = timer()
                     skip_initial_wv = False
             time = timer()
+            metrics.report(time)
             if verbose:
                 print line,
             if time - start_t > time_lim:
                 break
-            str_data.append(line)
-
+            wf_buffer.feed(line)
+            if '---------------------------' in line:
+                metrics.count('waveforms')
+
+            if wf_buffer.n_wf == n_done:
+                continue
+            n_done = wf_buffer.n_wf
+            if monitor is not None:
+                start_monitor = timer()
+                monitor.add(
+                    wf_buffer.data[n_done-1,:,1], wf_buffer.data[n_done-1,0,5]
+                )
+                monitor.report(time)
+                metrics.time('monitor', timer() - start_monitor)
             if live:
-                try: d = map(int, parse(line))
-                except: continue
-                if len(d) == 0: continue
-                if d[0] == 0:
-                    if live_data == []: continue
-                    ax.set_xlim(0, xmax)
-                    ax.set_ylim(ymin, ymax)
-                    # ax.set_ylim(9070-50, 9070+10)
-                    ax.xaxis.grid(True, which='major')
-                    ax.yaxis.grid(True, which='major')
-                    ld = np.vstack(live_data)
-                    ax.scatter(ld[:,0], ld[:,1], marker='o', c='crimson')
-                    ax.plot(ld[:,0], ld[:,1], linestyle='--', linewidth=1,
-                            c='crimson')
-                    diff = np.max(ld[:,1]) - np.min(ld[:,1])
-                    at = AnchoredText('min = {0}\nmax = {1}\ndiff = '
-                                      '{2}'.format(ymin, ymax, diff),
-                                      prop=dict(size=14), frameon=True, loc=1)
-                    at.patch.set_boxstyle("round,pad=0.,rounding_size=0.5")
-                    ax.add_artist(at)
-                    plt.pause(0.001)
-                    ax.cla()
-                    live_data = []
-                if d[0] > xmax: xmax = d[0]
-                if d[1] < ymin: ymin = d[1]
-                if d[1] > ymax: ymax = d[1]
-                live_data.append([d[0], d[1]])
+                # hand over the waveform just completed, dropping it if the
+                # display is behind
+                start_queue = timer()
+                wf = wf_buffer.data[n_done-1,:,:2].copy()
+                try:
+                    live_queue.put_nowait(wf)
+                except Full:
+                    metrics.count('live_dropped')
+                metrics.time('live', timer() - start_queue)
     except:
         os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+        if live:
+            stop_live(live_queue, display)
         raise
     os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+    if live:
+        stop_live(live_queue, display)
 
-    n_count = 0
-    nsamples = 0
-    timestamp = 0
-    local_time = 0
-    raw_data = []
-    for idx in range(len(str_data)):
-        if 'Nsamples' in str_data[idx] and nsamples == 0:
-            nsamples = int(str_data[idx].split()[2])
-            continue
-        if 'timestamp' in str_data[idx]:
-            timestamp = int(str_data[idx].split()[3][:-1])
-            continue
-        if 'local time' in str_data[idx]:
-            local_time = int(str_data[idx].split()[4][:-1])
-            continue
-        if nsamples == 0: continue
-        if ',' not in str_data[idx]: continue
-        if len(str_data[idx].split()) != 5: continue
-        try: timing = int(str_data[idx].split()[0][:-1])
-        except: continue
-        if verbose:
-            print timing, n_count
-        if timing == 0 and n_count != 0:
-            # remove incomplete waveforms
-            raw_data = raw_data[:-n_count]
-            n_count = 0
-        if n_count == 0 and timing != 0:
-            n_count = timing
-        if timing != n_count:
-            raise AssertionError(
-                'Something went wrong! timing != n_count! {0} != '
-                '{1}\n{2}'.format(timing, n_count, str_data[idx])
-            )
-        raw_data.append(map(int, parse(str_data[idx])) + [timestamp, local_time])
-        if n_count >= nsamples: n_count += 1
-        elif n_count == nsamples-1: n_count = 0
-        else: n_count += 1
-    raw_data = np.array(raw_data)
-    try:
-        data = check_data(raw_data, nsamples, verbose)
-    except:
-        print 'Error occured, dumping data to dump.npy'
-        np.save('dump', raw_data)
-        raise
-
-    timings, run_counts = np.unique(data[:,0], return_counts=True)
-
-    if len(set(run_counts)) != 1:
-        print 'Error occured, dumping data to dump.npy'
-        np.save('dump', data)
-        raise AssertionError(
-            'Something bad happened!\nrun_counts = {0}\nlen(set(run_counts)) '
-            '= {1}'.format(run_counts, len(set(run_counts)))
-        )
-    run_counts = run_counts[0]
-
-    try:
-        trns_data = data.reshape(run_counts, len(timings), data.shape[1])
-    except:
-        print 'Error occured, dumping data to dump.npy'
-        np.save('dump', data)
-        raise
+    start_post = timer()
+    data = wf_buffer.result()
+    metrics.count('incomplete', wf_buffer.incomplete)
     if verbose:
-        print 'trns_data', trns_data
-        print 'trns_data.shape', trns_data.shape
+        print 'data', data
+        print 'data.shape', data.shape
+    metrics.time('postprocess', timer() - start_post)
 
-    return trns_data
+    return data
 
 
 def main():
     args = parse_args()
-    data = run(args.infile, args.ddc_file, args.time, args.live, args.verbose)
+    metrics = Metrics(args.metrics_interval)
+    monitor = None
+    if args.monitor:
+        monitor = ChargeMonitor(
+            bins=args.monitor_bins, charge_range=args.monitor_range,
+            interval=args.monitor_interval, invert=not args.no_invert
+        )
+    data = run(args.infile, args.ddc_file, args.time, args.live, args.verbose,
+               metrics, args.replay, args.replay_rate, args.live_fps, monitor)
+    metrics.summary(args.metrics)
+    if monitor is not None:
+        monitor.report(force=True)
 
     print 'Number of waveforms = {0}'.format(data.shape[0])
 
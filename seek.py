@@ -0,0 +1,596 @@
+#!/usr/bin/env python2
+"""
+Index the waveforms of text level0 runs for random access
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import ctypes
+import ctypes.util
+import os
+
+import numpy as np
+
+from l1 import (
+    L0_SEEK_FILE, SEPARATOR, decode_samples, iter_waveforms, l0_files,
+    run_nsamples
+)
+
+
+# Uncompressed bytes between checkpoints of a gzipped chunk
+SPAN = 1 << 20
+# deflate looks back at most 32 kB, which a checkpoint must hold
+WINDOW_SIZE = 1 << 15
+READ_SIZE = 1 << 16
+OUT_SIZE = 1 << 18
+
+# tail_chunk and tail_offset give where the waveform being written at the end
+# of each chunk starts
+CHUNK_DTYPE = np.dtype([
+    ('name', 'S64'), ('size', '<i8'), ('mtime', '<f8'), ('tail_chunk', '<i4'),
+    ('tail_offset', '<i8')
+])
+WAVEFORM_DTYPE = np.dtype([
+    ('chunk', '<i4'), ('offset', '<i8'), ('length', '<i4'),
+    ('fpga_ts', '<i8'), ('nsamples', '<i4'), ('complete', '?')
+])
+POINT_DTYPE = np.dtype([
+    ('chunk', '<i4'), ('in', '<i8'), ('out', '<i8'), ('bits', 'u1')
+])
+
+# zlib inflate, whose stream can be primed with a bit offset and a window to
+# resume decompression at a block boundary, which the zlib module can not do
+Z_OK, Z_STREAM_END, Z_BUF_ERROR = 0, 1, -5
+Z_BLOCK = 5
+_libz = ctypes.CDLL(ctypes.util.find_library('z'))
+_libz.zlibVersion.restype = ctypes.c_char_p
+
+_index_cache = {}
+
+
+def parse_args():
+    """Get command line arguments"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-i', '--runs', type=str, nargs='+', metavar='FOLDER', required=True,
+        help='''Paths to the level0 run folders to index'''
+    )
+    parser.add_argument(
+        '-s', '--span', type=int, default=SPAN, metavar='BYTES',
+        required=False,
+        help='''Uncompressed bytes between checkpoints of gzipped chunks'''
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', default=False,
+        help='''Verbose mode'''
+    )
+    args = parser.parse_args()
+    return args
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong)
+    ]
+
+
+class Inflater(object):
+    """Thin wrapper around the inflate stream of zlib
+
+    wbits is 47 to read a gzip file from its start and -15 to read raw
+    deflate data from a checkpoint.
+    """
+    def __init__(self, wbits):
+        self.stream = ZStream()
+        self._input = None
+        self._output = ctypes.create_string_buffer(OUT_SIZE)
+        self._check(_libz.inflateInit2_(
+            ctypes.byref(self.stream), wbits, _libz.zlibVersion(),
+            ctypes.sizeof(ZStream)
+        ))
+
+    def _check(self, ret):
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise AssertionError('inflate failed: {0} ({1})'.format(
+                self.stream.msg, ret
+            ))
+        return ret
+
+    def prime(self, bits, value):
+        self._check(_libz.inflatePrime(ctypes.byref(self.stream), bits, value))
+
+    def set_dictionary(self, window):
+        self._check(_libz.inflateSetDictionary(
+            ctypes.byref(self.stream), window, len(window)
+        ))
+
+    def feed(self, data):
+        """Set the next compressed input, once the last is used up"""
+        self._input = ctypes.create_string_buffer(data, len(data))
+        self.stream.next_in = ctypes.addressof(self._input)
+        self.stream.avail_in = len(data)
+
+    def inflate(self, flush=0):
+        """Decompress what fits in the output buffer, returning (ret, data)"""
+        self.stream.next_out = ctypes.addressof(self._output)
+        self.stream.avail_out = OUT_SIZE
+        ret = self._check(_libz.inflate(ctypes.byref(self.stream), flush))
+        return ret, ctypes.string_at(
+            self._output, OUT_SIZE - self.stream.avail_out
+        )
+
+    def close(self):
+        _libz.inflateEnd(ctypes.byref(self.stream))
+
+
+class WaveformScanner(object):
+    """Find the position and timestamp of each waveform in level0 text
+
+    The text of each chunk is fed in pieces of any size. A waveform spans
+    from the end of the previous separator line to the end of its own,
+    possibly over the end of a chunk as l1 streams the chunks of a run one
+    after the other, and those whose header was not recorded are skipped as
+    l1 does. Each waveform is recorded as the chunk and offset it starts at,
+    its length, its FPGA timestamp, its Nsamples and whether all its samples
+    were recorded.
+    """
+    def __init__(self, chunk=0, carry=None):
+        self.chunk = chunk
+        self.offset = 0
+        self.pending = ''
+        # (chunk, offset, text) of a waveform started in previous chunks
+        self.carry = carry
+        self.waveforms = []
+
+    def next_chunk(self, chunk):
+        """Start feeding the text of the next chunk"""
+        text = (self.carry[2] if self.carry else '') + self.pending
+        self.carry = self.tail() + (text,) if text else None
+        self.chunk = chunk
+        self.offset = 0
+        self.pending = ''
+
+    def tail(self):
+        """Chunk and offset of the waveform being fed"""
+        if self.carry is not None:
+            return self.carry[:2]
+        return (self.chunk, self.offset)
+
+    def feed(self, text):
+        self.pending += text
+        start = 0
+        while True:
+            end = self.pending.find(SEPARATOR, start)
+            if end < 0:
+                break
+            end = self.pending.find('\n', end)
+            if end < 0:
+                break
+            end += 1
+            self._add(self.pending[start:end])
+            start = end
+        self.pending = self.pending[start:]
+        return None
+
+    def _add(self, block):
+        chunk, offset = self.tail()
+        length = len(block)
+        if self.carry is not None:
+            block = self.carry[2] + block
+            self.carry = None
+        for wf in iter_waveforms(block.splitlines(True)):
+            self.waveforms.append((
+                chunk, offset, len(block), wf.fpga_ts, wf.nsamples,
+                len(wf.samples) == wf.nsamples
+            ))
+        self.offset += length
+
+    def flush(self):
+        """Add the last waveform, if the run does not end in a separator"""
+        if self.carry is not None or self.pending.strip():
+            self._add(self.pending)
+        self.pending = ''
+        return self.waveforms
+
+
+def index_chunk(filename, scanner, span=SPAN):
+    """One pass over a level0 chunk, feeding its text to a WaveformScanner
+
+    A checkpoint is taken at the first deflate block boundary after every
+    span bytes of uncompressed text, with the bit offset into the compressed
+    file and the last WINDOW_SIZE bytes of text needed to resume from it.
+    Returns the (in, out, bits) offsets of the checkpoints and their
+    windows. A truncated chunk, e.g. one still being written, is indexed up
+    to where it ends.
+    """
+    points = []
+    windows = []
+    if not filename.endswith('.gz'):
+        with open(filename, 'rb') as f:
+            for data in iter(lambda: f.read(READ_SIZE), ''):
+                scanner.feed(data)
+        return points, windows
+
+    inflater = Inflater(47)
+    window = ''
+    last = 0
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                if inflater.stream.avail_in == 0:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    inflater.feed(data)
+                ret, text = inflater.inflate(Z_BLOCK)
+                scanner.feed(text)
+                window = (window + text)[-WINDOW_SIZE:]
+                if ret == Z_STREAM_END:
+                    break
+                data_type = inflater.stream.data_type
+                total_out = inflater.stream.total_out
+                if data_type & 128 and not data_type & 64 and (
+                        total_out == 0 or total_out - last > span):
+                    points.append(
+                        (inflater.stream.total_in, total_out, data_type & 7)
+                    )
+                    windows.append(window.rjust(WINDOW_SIZE, '\0'))
+                    last = total_out
+    finally:
+        inflater.close()
+    return points, windows
+
+
+class ChunkReader(object):
+    """Read spans of the uncompressed text of a level0 chunk
+
+    Gzipped chunks are decompressed from the nearest checkpoint before each
+    span, or onwards from the previous span when no checkpoint lies between
+    them, so reading spans in order decompresses the chunk at most once.
+    """
+    def __init__(self, filename, points=None, windows=None):
+        self.filename = filename
+        self.points = points
+        self.windows = windows
+        self.file = open(filename, 'rb')
+        self.inflater = None
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+
+    def read(self, offset, length=None):
+        """Read length bytes of text from offset, or up to the end"""
+        if not self.filename.endswith('.gz'):
+            self.file.seek(offset)
+            return self.file.read(-1 if length is None else length)
+        ipoint = np.searchsorted(self.points['out'], offset, 'right') - 1
+        start = self.points['out'][ipoint] if ipoint >= 0 else 0
+        if self.inflater is None or offset < self.pos or \
+                start > self.pos + len(self.buffer):
+            self._start(ipoint)
+        end = None if length is None else offset + length
+        while end is None or self.pos + len(self.buffer) < end:
+            text = self._inflate()
+            if not text:
+                break
+            if self.pos + len(self.buffer) < offset:
+                # drop text before the span as it comes
+                self.pos += len(self.buffer)
+                self.buffer = ''
+            self.buffer += text
+        start = offset - self.pos
+        data = self.buffer[start:None if end is None else end - self.pos]
+        self.pos = offset + len(data)
+        self.buffer = self.buffer[start+len(data):]
+        return data
+
+    def _start(self, ipoint):
+        """Start decompressing from a checkpoint, or the start if negative"""
+        self.close_inflater()
+        self.buffer = ''
+        self.done = False
+        if ipoint < 0:
+            self.inflater = Inflater(47)
+            self.file.seek(0)
+            self.pos = 0
+            return
+        point = self.points[ipoint]
+        self.inflater = Inflater(-15)
+        self.file.seek(int(point['in']) - (1 if point['bits'] else 0))
+        if point['bits']:
+            byte = ord(self.file.read(1))
+            self.inflater.prime(
+                int(point['bits']), byte >> (8 - int(point['bits']))
+            )
+        if point['out']:
+            self.inflater.set_dictionary(self.windows[ipoint].tostring())
+        self.pos = int(point['out'])
+
+    def _inflate(self):
+        while not self.done:
+            if self.inflater.stream.avail_in == 0:
+                data = self.file.read(READ_SIZE)
+                if not data:
+                    self.done = True
+                    break
+                self.inflater.feed(data)
+            ret, text = self.inflater.inflate()
+            if ret == Z_STREAM_END:
+                self.done = True
+            if text:
+                return text
+        return ''
+
+    def close_inflater(self):
+        if self.inflater is not None:
+            self.inflater.close()
+            self.inflater = None
+
+    def close(self):
+        self.close_inflater()
+        self.file.close()
+
+
+class RunReader(object):
+    """Read the text of waveforms of a run, which may span several chunks"""
+    def __init__(self, run, index):
+        self.run = run
+        self.index = index
+        self.readers = {}
+
+    def reader(self, ichunk):
+        if ichunk not in self.readers:
+            point_mask = self.index['points']['chunk'] == ichunk
+            self.readers[ichunk] = ChunkReader(
+                os.path.join(self.run, self.index['chunks'][ichunk]['name']),
+                self.index['points'][point_mask],
+                self.index['windows'][point_mask]
+            )
+        return self.readers[ichunk]
+
+    def read(self, ichunk, offset, length=None, stop=None):
+        """Read length bytes from offset into a chunk, going on to the next
+        chunks as needed, or all the text up to the chunk stop"""
+        if stop is None:
+            stop = len(self.index['chunks'])
+        # waveforms are read in order, so earlier chunks are done with
+        for done in [i for i in self.readers if i < ichunk]:
+            self.readers.pop(done).close()
+        pieces = []
+        while ichunk < stop and (length is None or length > 0):
+            text = self.reader(ichunk).read(offset, length)
+            pieces.append(text)
+            if length is not None:
+                length -= len(text)
+            ichunk += 1
+            offset = 0
+        return ''.join(pieces)
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+
+def load_index(run):
+    """Load the seek index of a run
+
+    The index is empty if there is none, or if it was saved without the
+    fields of the current WAVEFORM_DTYPE.
+    """
+    seek_file = os.path.join(run, L0_SEEK_FILE)
+    if os.path.exists(seek_file):
+        with np.load(seek_file) as npz:
+            index = dict((key, npz[key]) for key in npz.files)
+        if index['waveforms'].dtype == WAVEFORM_DTYPE:
+            return index
+    return {
+        'chunks': np.empty(0, dtype=CHUNK_DTYPE),
+        'waveforms': np.empty(0, dtype=WAVEFORM_DTYPE),
+        'points': np.empty(0, dtype=POINT_DTYPE),
+        'windows': np.empty((0, WINDOW_SIZE), dtype=np.uint8)
+    }
+
+
+def build_index(run, span=SPAN, verbose=False):
+    """Index the text level0 chunks of a run folder, saving it in the folder
+
+    The index of the chunks up to the first new or changed one, by size and
+    modification time, is kept, so only the chunks added to a run or still
+    being written are read again. Returns the index, with one record per
+    chunk, per waveform and per checkpoint, and the window of each
+    checkpoint.
+    """
+    filenames = l0_files(run)
+    if any(filename.endswith('.bin') for filename in filenames):
+        raise AssertionError(
+            'Binary level0 runs are indexed as they are written'
+        )
+    old = load_index(run)
+    chunks = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        chunks.append(
+            (os.path.basename(filename), stat.st_size, stat.st_mtime)
+        )
+    first = 0
+    for chunk, old_chunk in zip(chunks, old['chunks']):
+        if chunk != tuple(old_chunk)[:3]:
+            break
+        first += 1
+    if first == len(chunks) == len(old['chunks']):
+        return old
+
+    # keep the waveforms completed before the first changed chunk
+    old_chunks = old['chunks'][:first]
+    waveforms = old['waveforms']
+    points = old['points'][old['points']['chunk'] < first]
+    windows = old['windows'][old['points']['chunk'] < first]
+    carry = None
+    if first > 0:
+        tail = (old_chunks[-1]['tail_chunk'], old_chunks[-1]['tail_offset'])
+        waveforms = waveforms[
+            (waveforms['chunk'] < tail[0]) |
+            ((waveforms['chunk'] == tail[0]) & (waveforms['offset'] < tail[1]))
+        ]
+        reader = RunReader(run, old)
+        try:
+            text = reader.read(int(tail[0]), int(tail[1]), stop=first)
+        finally:
+            reader.close()
+        if text:
+            carry = (int(tail[0]), int(tail[1]), text)
+    else:
+        waveforms = waveforms[:0]
+
+    scanner = WaveformScanner(first, carry)
+    tails = [tuple(chunk)[3:] for chunk in old_chunks]
+    new_points, new_windows = [], []
+    for ichunk in range(first, len(filenames)):
+        if verbose:
+            print 'indexing {0}'.format(filenames[ichunk])
+        if ichunk > first:
+            scanner.next_chunk(ichunk)
+        chunk_points, chunk_windows = index_chunk(
+            filenames[ichunk], scanner, span
+        )
+        new_points += [(ichunk,) + point for point in chunk_points]
+        new_windows += chunk_windows
+        tails.append(scanner.tail())
+
+    index = {
+        'chunks': np.array(
+            [chunk + tail for chunk, tail in zip(chunks, tails)],
+            dtype=CHUNK_DTYPE
+        ),
+        'waveforms': np.concatenate([
+            waveforms, np.array(scanner.flush(), dtype=WAVEFORM_DTYPE)
+        ]),
+        'points': np.concatenate([
+            points, np.array(new_points, dtype=POINT_DTYPE)
+        ]),
+        'windows': np.concatenate([
+            windows, np.frombuffer(
+                ''.join(new_windows), dtype=np.uint8
+            ).reshape(-1, WINDOW_SIZE)
+        ])
+    }
+    seek_file = os.path.join(run, L0_SEEK_FILE)
+    tmp_file = '{0}.{1}.npz'.format(seek_file, os.getpid())
+    np.savez_compressed(tmp_file, **index)
+    os.rename(tmp_file, seek_file)
+    _index_cache.pop(os.path.abspath(run), None)
+    return index
+
+
+def get_index(run):
+    """Seek index of a run, building it if missing and caching it in memory"""
+    run = os.path.abspath(run)
+    seek_file = os.path.join(run, L0_SEEK_FILE)
+    mtime = os.path.getmtime(seek_file) if os.path.exists(seek_file) else None
+    if run not in _index_cache or _index_cache[run][0] != mtime:
+        index = load_index(run)
+        if not len(index['chunks']):
+            index = build_index(run)
+            mtime = os.path.getmtime(seek_file)
+        _index_cache[run] = (mtime, index)
+    return _index_cache[run][1]
+
+
+def l1_records(index):
+    """Records of a seek index of the waveforms l1 keeps, in their order
+
+    l1 skips the incomplete waveforms and those with another Nsamples than
+    the run, see run_nsamples, so waveform i of the level1 file of a run is
+    record l1_records(index)[i] of its seek index.
+    """
+    waveforms = index['waveforms']
+    complete = waveforms['complete']
+    lengths = dict(zip(*np.unique(
+        waveforms['nsamples'][complete], return_counts=True
+    )))
+    return np.flatnonzero(
+        complete & (waveforms['nsamples'] == run_nsamples(lengths))
+    )
+
+
+def read_waveforms(run, indices):
+    """Read the waveforms of a run with the given indices into its seek index
+
+    The waveforms are read in the order they were recorded, so that each
+    chunk is decompressed at most once. Returns a list of (wf, samples) in
+    the order of indices, with the L0Waveform record of each waveform and
+    its samples decoded into an array with one column per SAMPLE_COLUMNS.
+    """
+    index = get_index(run)
+    records = index['waveforms'][indices]
+    result = [None] * len(records)
+    reader = RunReader(run, index)
+    try:
+        order = np.lexsort((records['offset'], records['chunk']))
+        for pos in order:
+            record = records[pos]
+            text = reader.read(
+                int(record['chunk']), int(record['offset']),
+                int(record['length'])
+            )
+            waveforms = list(iter_waveforms(text.splitlines(True)))
+            if len(text) != record['length'] or len(waveforms) != 1:
+                raise AssertionError(
+                    'Seek index of {0} is out of date'.format(run)
+                )
+            rows, _ = decode_samples(waveforms)
+            result[pos] = (waveforms[0], rows)
+    finally:
+        reader.close()
+    return result
+
+
+def get_waveform(run, i):
+    """Waveform i of the level1 file of a run as (wf, samples)
+
+    See l1_records and read_waveforms.
+    """
+    records = l1_records(get_index(run))
+    n_wf = len(records)
+    if not -n_wf <= i < n_wf:
+        raise IndexError('Run {0} has {1} level1 waveforms'.format(run, n_wf))
+    return read_waveforms(run, [records[i]])[0]
+
+
+def get_range(run, t0, t1):
+    """Waveforms l1 keeps of a run with t0 <= fpga_ts < t1 as (wf, samples)"""
+    index = get_index(run)
+    records = l1_records(index)
+    fpga_ts = index['waveforms']['fpga_ts'][records]
+    return read_waveforms(run, records[(fpga_ts >= t0) & (fpga_ts < t1)])
+
+
+def main():
+    args = parse_args()
+    for run in args.runs:
+        index = build_index(run, args.span, args.verbose)
+        print '{0}: {1} waveforms, {2} kept by l1, in {3} chunks, {4} ' \
+            'checkpoints'.format(
+                run, len(index['waveforms']), len(l1_records(index)),
+                len(index['chunks']), len(index['points'])
+            )
+
+    print '=========='
+    print 'DONE'
+    print '=========='
+
+
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
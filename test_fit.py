@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+"""
+Tests of the fitting of charge spectra, run with python -m unittest discover
+"""
+import unittest
+
+import numpy as np
+
+import fit as fit_engine
+
+
+BINNING = np.linspace(-20., 120., 141)
+BIN_CENTRES = (BINNING[:-1] + BINNING[1:]) / 2.
+
+
+def spectrum(lam, q0, s0, q1, s1, n=20000, seed=0):
+    """Poisson fluctuated multi_pe histogram over BINNING"""
+    expected = fit_engine.multi_pe(BIN_CENTRES, n, lam, q0, s0, q1, s1)
+    return np.random.RandomState(seed).poisson(expected)
+
+
+class TestFitSpectrum(unittest.TestCase):
+
+    def test_resolved_peaks(self):
+        hist = spectrum(1.5, 0., 2., 20., 3.)
+        for method in fit_engine.METHODS:
+            result = fit_engine.fit_spectrum(
+                hist, BINNING, 'multi_pe', method
+            )
+            self.assertTrue(result['success'])
+            self.assertAlmostEqual(result['lam'], 1.5, delta=0.1)
+            self.assertAlmostEqual(result['q1'], 20., delta=0.5)
+
+    def test_unresolved_high_pe(self):
+        # 30 PE of 1.5 nVs under a 4 nVs wide pedestal look like one gaussian
+        for seed in range(3):
+            hist = spectrum(30., 0., 4., 1.5, 0.8, seed=seed)
+            for method in fit_engine.METHODS:
+                result = fit_engine.fit_spectrum(
+                    hist, BINNING, 'multi_pe', method
+                )
+                self.assertFalse(result['success'])
+
+    def test_degenerate(self):
+        width = BINNING[1] - BINNING[0]
+        self.assertFalse(fit_engine.degenerate(
+            [1e4, 1.5, 0., 2., 20., 3.], 'multi_pe', width
+        ))
+        # q1 on its bound
+        self.assertTrue(fit_engine.degenerate(
+            [1e4, 1.5, 0., 2., 1e-6, 3.], 'multi_pe', width
+        ))
+        # q1 smaller than a bin, e.g. 6e-5 nVs for a gain of 2e3
+        self.assertTrue(fit_engine.degenerate(
+            [1e4, 17., 31., 1e-2, 6e-5, 1e-3], 'multi_pe', width
+        ))
+        self.assertFalse(fit_engine.degenerate(
+            [100., 30., 5.], 'gauss', width
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
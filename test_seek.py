@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+"""
+Tests of the seek index of level0 runs, run with python -m unittest discover
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import seek
+from l1 import (
+    SEPARATOR, iter_waveforms, l0_files, l0_lines, l1_waveforms,
+    read_header, read_run_start
+)
+
+
+BASELINE = 9070
+NSAMPLES = 32
+HEADER = '''              word   len  full  state  empty  loop  reenter  run \
+start_idx  stop_idx trig
+header: 0x01205830   288     0      5      1     0        0    0         0 \
+        3    0
+footer: 0x01201030   288     0      1      0     0        0    0         0 \
+        3    0
+'''
+
+
+def sample_lines(n, rng):
+    """Sample lines of a waveform of noise around the baseline"""
+    return [
+        '{0:5d}, {1:5d}, {2:5d},   0,   0, \n'.format(
+            i, BASELINE + rng.randint(-5, 6), 1000 + i
+        ) for i in range(n)
+    ]
+
+
+def waveform_lines(fpga_ts, nsamples, rng, n_lines=None):
+    """Level0 lines of a waveform, of n_lines samples if it is incomplete"""
+    lines = [HEADER, '\n']
+    lines.append('start timestamp  =    {0}, 0x  {0:x}\n'.format(fpga_ts))
+    lines.append('start local time =           {0}, 0x        {0:x}\n'.format(
+        fpga_ts % (1 << 16)
+    ))
+    lines += ['\n', 'Nsamples = {0}\n'.format(nsamples), '\n']
+    lines.append('isamp   adc   time  tot  eoe\n')
+    lines += sample_lines(nsamples if n_lines is None else n_lines, rng)
+    return lines + ['\n']
+
+
+class TestSeek(unittest.TestCase):
+
+    def setUp(self):
+        """Write a run in two gzipped chunks, split inside a waveform
+
+        It starts with the end of a waveform without a header and has
+        incomplete waveforms and complete ones of other lengths, the first
+        of them before any of NSAMPLES.
+        """
+        rng = np.random.RandomState(0)
+        waveforms = [sample_lines(10, rng)]
+        for i in range(60):
+            nsamples, n_lines = NSAMPLES, None
+            if i in (0, 25):
+                nsamples = 24
+            elif i in (7, 30, 59):
+                n_lines = 20
+            waveforms.append(waveform_lines(
+                1000000 + 5000 * i, nsamples, rng, n_lines
+            ))
+        lines = ['BASELINE = {0}\n'.format(BASELINE), '\n']
+        for wf in waveforms:
+            lines += wf + [SEPARATOR + '\n']
+        self.run_dir = tempfile.mkdtemp()
+        cut = len(lines) // 2 + 5
+        for i, chunk in enumerate((lines[:cut], lines[cut:])):
+            filename = os.path.join(
+                self.run_dir, 'level0_{0:06d}.txt.gz'.format(i)
+            )
+            with gzip.open(filename, 'wb') as f:
+                f.write(''.join(chunk))
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_l1_numbering(self):
+        filenames = l0_files(self.run_dir)
+        baseline, _ = read_header(filenames[0])
+        _, nsamples, skipped = read_run_start(filenames)
+        self.assertEqual(nsamples, NSAMPLES)
+        self.assertEqual(skipped, {'incomplete': 3, 'other_nsamples': 2})
+        adc, wf = l1_waveforms(
+            iter_waveforms(l0_lines(filenames)), baseline, nsamples, False,
+            'spline', None, False
+        )
+
+        # small spans to resume from checkpoints within the chunks
+        index = seek.build_index(self.run_dir, span=4096)
+        self.assertTrue(len(index['points']))
+        self.assertEqual(len(index['waveforms']), 60)
+        self.assertEqual(len(seek.l1_records(index)), len(wf))
+        for i in range(len(wf)):
+            record, samples = seek.get_waveform(self.run_dir, i)
+            self.assertEqual(record.fpga_ts, wf['fpga_ts'][i])
+            self.assertTrue(np.array_equal(baseline - samples[:, 1], adc[i]))
+        with self.assertRaises(IndexError):
+            seek.get_waveform(self.run_dir, len(wf))
+
+        t0, t1 = wf['fpga_ts'][10], wf['fpga_ts'][20]
+        self.assertEqual(
+            [record.fpga_ts for record, _ in seek.get_range(
+                self.run_dir, t0, t1
+            )],
+            list(wf['fpga_ts'][10:20])
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
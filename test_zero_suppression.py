@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+"""
+Tests of the online zero suppression, run with python -m unittest discover
+"""
+import unittest
+
+import numpy as np
+
+from zero_suppression import ZeroSuppression
+
+
+BASELINE = 9070
+NSAMPLES = 320
+
+
+def waveform(height):
+    """Raw ADC counts of a pulse of height counts above the baseline
+
+    DDC2 pulses go down from the baseline, so a negative height is a pulse
+    as recorded and a positive one what l1 --no-invert expects.
+    """
+    t = np.arange(NSAMPLES)
+    pulse = height * np.exp(-(t - 100.)**2 / 50.)
+    return np.round(BASELINE + pulse).astype(int)
+
+
+class TestZeroSuppression(unittest.TestCase):
+
+    def check_polarity(self, invert, **cuts):
+        sign = -1 if invert else 1
+        zs = ZeroSuppression(BASELINE, invert=invert, **cuts)
+        self.assertTrue(zs.keep(waveform(sign * 1000)))
+        self.assertFalse(zs.keep(waveform(-sign * 1000)))
+        self.assertFalse(zs.keep(waveform(0)))
+        self.assertEqual(zs.summary(), {
+            'seen': 3, 'kept': 1, 'prescaled': 0, 'rejected': 2
+        })
+
+    def test_threshold(self):
+        # 1000 counts is 220 mV
+        for invert in (True, False):
+            self.check_polarity(invert, threshold=100.)
+
+    def test_min_charge(self):
+        # about 2.7 nVs for 1000 counts
+        for invert in (True, False):
+            self.check_polarity(invert, min_charge=1.)
+
+    def test_prescale(self):
+        zs = ZeroSuppression(BASELINE, threshold=100., prescale=3)
+        kept = [zs.keep(waveform(0)) for _ in range(9)]
+        self.assertEqual(kept, [False, False, True] * 3)
+        summary = zs.chunk_summary()
+        self.assertEqual(summary['prescaled'], 3)
+        self.assertEqual(summary['rejected'], 9)
+        self.assertTrue(summary['invert'])
+        self.assertEqual(zs.chunk_summary()['seen'], 0)
+
+    def test_other_nsamples_kept(self):
+        zs = ZeroSuppression(BASELINE, threshold=100.)
+        self.assertFalse(zs.keep(waveform(0)))
+        self.assertTrue(zs.keep(np.full(NSAMPLES // 2, BASELINE)))
+        self.assertEqual(zs.summary()['seen'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
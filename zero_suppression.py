@@ -0,0 +1,90 @@
+#!/usr/bin/env python2
+"""
+Online zero suppression of the DDC2 acquisition.
+"""
+import numpy as np
+
+import charge as charge_engine
+from l1 import CLOCK, LSB
+
+
+class ZeroSuppression(object):
+    """Keep or drop each waveform of an acquisition as it is completed
+
+    keep subtracts the DDC2 baseline from the raw ADC counts and, unless
+    invert is False as with l1 --no-invert, inverts them as l1 does. It
+    keeps a waveform if its amplitude reaches threshold mV and its charge
+    min_charge nVs, the cuts which are not None. This takes a fixed number
+    of operations per sample, the charge being a dot product with the
+    quadrature weights of l1. One in every prescale rejected waveforms is
+    kept anyway, none if prescale is 0. Waveforms with a different number of
+    samples to the first are always kept, l1 skips them. The waveforms seen,
+    kept by the cuts, rejected by them and prescaled, i.e. rejected but kept
+    anyway, are counted both for the whole run and since the last call to
+    chunk_summary.
+    """
+    COUNTS = ['seen', 'kept', 'prescaled', 'rejected']
+
+    def __init__(self, baseline=None, threshold=None, min_charge=None,
+                 prescale=0, method='spline', invert=True):
+        self.baseline = baseline
+        self.threshold = threshold
+        self.min_charge = min_charge
+        self.prescale = prescale
+        self.method = method
+        self.invert = invert
+        self.nsamples = None
+        self.weights = None
+        self.totals = dict((name, 0) for name in self.COUNTS)
+        self.counts = dict((name, 0) for name in self.COUNTS)
+
+    def count(self, name):
+        """Count a waveform for the run and the chunk"""
+        self.totals[name] += 1
+        self.counts[name] += 1
+
+    def keep(self, adc):
+        """Whether to keep a waveform, from its raw ADC counts"""
+        if self.baseline is None:
+            raise AssertionError('baseline not set')
+        if self.nsamples is None:
+            self.nsamples = len(adc)
+            self.weights = charge_engine.quadrature_weights(
+                len(adc), CLOCK, self.method
+            )
+        elif len(adc) != self.nsamples:
+            return True
+        self.count('seen')
+        if self.invert:
+            pulse = self.baseline - np.asarray(adc)
+        else:
+            pulse = np.asarray(adc) - self.baseline
+        passed = True
+        if self.threshold is not None:
+            passed = pulse.max() * LSB >= self.threshold
+        if passed and self.min_charge is not None:
+            passed = np.dot(pulse, self.weights) * LSB / 1e3 >= \
+                self.min_charge
+        if passed:
+            self.count('kept')
+            return True
+        self.count('rejected')
+        if self.prescale and self.totals['rejected'] % self.prescale == 0:
+            self.count('prescaled')
+            return True
+        return False
+
+    def chunk_summary(self):
+        """Settings and counts since the last call, to save with a chunk"""
+        summary = {
+            'baseline': self.baseline, 'threshold': self.threshold,
+            'min_charge': self.min_charge, 'prescale': self.prescale,
+            'method': self.method, 'invert': self.invert
+        }
+        summary.update(self.counts)
+        self.counts = dict((name, 0) for name in self.COUNTS)
+        return summary
+
+    def summary(self):
+        """Counts of the whole run"""
+        return dict(self.totals)